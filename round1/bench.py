@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""Benchmark gen.py and resize.py on synthetic photo corpora.
+
+The corpora are generated offline into --corpus-dir and kept for the next
+runs: JPEGs with the EXIF blocks of a camera, and for gen.py the derivatives
+it links to. gen.py only reads the headers of the originals, so it is
+benchmarked at the first of --resolutions, resize.py at all of them.
+
+Every run is a separate process timed with its --profile. The results are
+written as JSON, two of them are compared with --compare.
+
+Example: ./bench.py --images 10 1000 20000 --output before.json
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import time
+
+import resize
+from derivatives import DERIVATIVES, save_json
+
+try:
+    from PIL import Image
+    from PIL.TiffImagePlugin import IFDRational
+except ImportError:
+    Image = None
+
+current_path = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = os.path.join(
+    current_path, "templates", "lightgallery_or_viewerjs_or_nojs.html"
+)
+
+# Bump this whenever make_corpus() changes the files it writes
+CORPUS_VERSION = 1
+CORPUS_MARKER = ".bench_corpus.json"
+# Relative to the folder of a corpus, which is the working directory of the runs
+BASEDIR = "img/max_resolution/Bench"
+# The originals the derivatives of every image are linked from
+BASES_DIR = "img/max_resolution/_bench_bases"
+
+PEAK_RSS_MARKER = "bench.py peak RSS: "
+# Runs a script with the arguments read from stdin, long filters do not fit in argv.
+# The ru_maxrss of a process includes the RSS of its parent when it was forked,
+# VmHWM only counts the pages mapped since exec.
+RUNNER = f"""
+import json, os, resource, runpy, sys
+sys.argv = json.load(sys.stdin)
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    with open("/proc/self/status") as fh:
+        status = dict(line.split(":", 1) for line in fh)
+    peak = int(status["VmHWM"].split()[0])
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print("{PEAK_RSS_MARKER}" + str(1024 * max(peak, children)), flush=True)
+"""
+# Printed by gen.py and resize.py when an image could not be processed
+ERROR_MARKERS = ["[ERROR]", "Unable to resize"]
+
+CAMERAS = [
+    ("FUJIFILM", "X-T5"),
+    ("SONY", "ILCE-7M4"),
+    ("Canon", "Canon EOS R6m2"),
+    ("NIKON CORPORATION", "NIKON Z 6_2"),
+]
+ARTISTS = ["Felina R.C.", 'Someone "Quoted" <b>Else</b>']
+EXPOSURE_TIMES = [(1, 4000), (1, 1000), (1, 250), (1, 60), (1, 8), (2, 1)]
+F_NUMBERS = [14, 18, 28, 40, 56, 80, 110]
+ISOS = [100, 200, 400, 800, 1600, 3200, 6400]
+FOCAL_LENGTHS = [16, 23, 35, 50, 56, 85, 135, 200]
+# Cameras write maker notes of tens of KiB, which EXIF readers have to skip
+MAKER_NOTE_SIZE = 16 * 1024
+PORTRAIT_RATIO = 0.25
+
+# Options of gen.py for every benchmark, all of them run with --force
+GEN_BENCHMARKS = {
+    "html": [],
+    "json": ["--output-format", "json"],
+    "exif-order": ["--order-from-exif", "--no-exif-cache"],
+    "exif-order-cached": ["--order-from-exif"],
+    "filter-order": ["--order-from-filter"],
+}
+BENCHMARKS = [*GEN_BENCHMARKS, "resize"]
+
+
+def parse_resolution(value: str) -> tuple[int, int]:
+    """Width and height from 6000x4000."""
+    try:
+        width, height = map(int, value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid resolution: {value!r}")
+    return width, height
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+parser.add_argument(
+    "--images",
+    help="Number of images of every gen.py corpus, e.g. 10 1000 20000.",
+    type=int,
+    nargs="+",
+    default=[10, 1000],
+)
+parser.add_argument(
+    "--resolutions",
+    help="Sizes of the originals, gen.py runs on the first one.",
+    type=parse_resolution,
+    nargs="+",
+    default=[(1500, 1000), (6000, 4000)],
+)
+parser.add_argument(
+    "--resize-images",
+    help="Number of originals resized by every resize.py run.",
+    type=int,
+    default=8,
+)
+parser.add_argument(
+    "--backends",
+    help="resize.py backends to benchmark.",
+    choices=list(resize.BACKENDS),
+    nargs="+",
+    default=["pillow"],
+)
+parser.add_argument(
+    "--benchmarks",
+    help="Which benchmarks to run.",
+    choices=BENCHMARKS,
+    nargs="+",
+    default=BENCHMARKS,
+)
+parser.add_argument(
+    "--repeat",
+    help="Timed runs of every benchmark, the median is reported.",
+    type=int,
+    default=3,
+)
+parser.add_argument(
+    "--warmup",
+    help="Untimed runs before the timed ones, they also fill the EXIF cache.",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--jobs",
+    "-j",
+    help="--jobs of resize.py.",
+    type=int,
+    default=os.cpu_count(),
+)
+parser.add_argument(
+    "--gen-args",
+    help="Extra options for every gen.py run, e.g. '--no-sidecars --page-size 200'.",
+    default="",
+)
+parser.add_argument(
+    "--corpus-dir",
+    help="Where the corpora are generated, they are reused while their settings match.",
+    default="bench-corpus",
+)
+parser.add_argument(
+    "--seed",
+    help="Seed of the random metadata and pixels of the corpora.",
+    type=int,
+    default=42,
+)
+parser.add_argument(
+    "--output",
+    "-o",
+    help="JSON file of the results.",
+    default="bench-results.json",
+)
+parser.add_argument(
+    "--compare",
+    help="Print the speedup of every benchmark over these earlier results.",
+    default="",
+)
+
+
+def synthetic_image(width: int, height: int, rng: random.Random) -> "Image.Image":
+    """Gradients with some grain, which compress about as well as photos."""
+    gradient = Image.linear_gradient("L")
+    channels = [
+        gradient.resize((width, height)),
+        gradient.rotate(90).resize((width, height)),
+        Image.radial_gradient("L").resize((width, height)),
+    ]
+    grain_size = (max(1, width // 8), max(1, height // 8))
+    grain = Image.frombytes(
+        "L", grain_size, rng.randbytes(grain_size[0] * grain_size[1])
+    ).resize((width, height))
+    return Image.merge(
+        "RGB", [Image.blend(channel, grain, 0.25) for channel in channels]
+    )
+
+
+def encode_jpeg(img: "Image.Image") -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def camera_exif(rng: random.Random, index: int, size: tuple[int, int]) -> bytes:
+    """The APP1 payload of a photo taken at a random time, with random settings."""
+    exif = Image.Exif()
+    exif[0x010F], exif[0x0110] = rng.choice(CAMERAS)
+    taken = datetime.datetime(2020, 1, 1) + datetime.timedelta(
+        seconds=rng.randrange(5 * 365 * 24 * 3600)
+    )
+    exif[0x0132] = taken.strftime("%Y:%m:%d %H:%M:%S")
+    if rng.random() < 0.5:
+        exif[0x013B] = rng.choice(ARTISTS)
+    exif[0x0112] = 1
+    ifd = exif.get_ifd(0x8769)
+    ifd[0x829A] = IFDRational(*rng.choice(EXPOSURE_TIMES))
+    ifd[0x829D] = IFDRational(rng.choice(F_NUMBERS), 10)
+    ifd[0x8827] = rng.choice(ISOS)
+    ifd[0x9003] = exif[0x0132]
+    ifd[0x920A] = IFDRational(rng.choice(FOCAL_LENGTHS), 1)
+    ifd[0x9286] = b"ASCII\0\0\0" + f"Frame {index}".encode()
+    ifd[0x927C] = rng.randbytes(MAKER_NOTE_SIZE)
+    ifd[0xA002], ifd[0xA003] = size
+    return exif.tobytes()
+
+
+def with_exif(jpeg: bytes, exif: bytes) -> bytes:
+    """The JPEG with an APP1 segment right after its start of image marker."""
+    assert jpeg[:2] == b"\xff\xd8"
+    return jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif + jpeg[2:]
+
+
+def link_or_copy(source: str, target: str):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def make_corpus(
+    directory: str,
+    count: int,
+    resolution: tuple[int, int],
+    seed: int,
+    derivatives: bool,
+) -> str:
+    """Generate the corpus in directory, unless it was already generated the same way.
+
+    The pixels are encoded once per orientation and every image gets its own
+    EXIF block. The derivatives are made once per orientation with Pillow and
+    hard linked, gen.py only reads their headers.
+    """
+    settings = {
+        "version": CORPUS_VERSION,
+        "images": count,
+        "resolution": list(resolution),
+        "seed": seed,
+        "derivatives": derivatives,
+    }
+    marker = os.path.join(directory, CORPUS_MARKER)
+    try:
+        with open(marker, "r", encoding="utf-8") as fh:
+            if json.load(fh) == settings:
+                return directory
+    except (FileNotFoundError, ValueError):
+        pass
+    width, height = resolution
+    print(f"Generating {count} images of {width}x{height} in {directory}")
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = random.Random(f"{seed} {count} {width}x{height}")
+    landscape = synthetic_image(width, height, rng)
+    bases = {}
+    for name, img in [
+        ("landscape", landscape),
+        ("portrait", landscape.transpose(Image.Transpose.ROTATE_90)),
+    ]:
+        path = os.path.join(directory, BASES_DIR, f"{name}.jpg")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        jpeg = encode_jpeg(img)
+        with open(path, "wb") as fh:
+            fh.write(jpeg)
+        if derivatives:
+            for derivative in DERIVATIVES:
+                os.makedirs(os.path.dirname(derivative.target(path)), exist_ok=True)
+            assert resize.PillowBackend().resize(path, tuple(DERIVATIVES))
+        bases[name] = path, jpeg, img.size
+
+    basedir = os.path.join(directory, BASEDIR)
+    os.makedirs(basedir)
+    for index in range(count):
+        base, jpeg, size = bases[
+            "portrait" if rng.random() < PORTRAIT_RATIO else "landscape"
+        ]
+        path = os.path.join(basedir, f"_BEN{index:05d}.jpg")
+        with open(path, "wb") as fh:
+            fh.write(with_exif(jpeg, camera_exif(rng, index, size)))
+        if derivatives:
+            for derivative in DERIVATIVES:
+                target = derivative.target(path)
+                if index == 0:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                link_or_copy(derivative.target(base), target)
+    save_json(marker, settings)
+    return directory
+
+
+def run_script(script: str, argv: list[str], cwd: str) -> tuple[float, int]:
+    """Wall time and peak RSS in bytes of the script or of its largest child."""
+    log_path = os.path.join(cwd, "bench.log")
+    with open(log_path, "wb") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-c", RUNNER],
+            stdin=subprocess.PIPE,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            cwd=cwd,
+        )
+        process.stdin.write(json.dumps([script, *argv]).encode())
+        process.stdin.close()
+        process.wait()
+        elapsed = time.perf_counter() - start
+    with open(log_path, "r", encoding="utf-8", errors="replace") as fh:
+        output = fh.read()
+    _, found, peak_rss = output.rpartition(PEAK_RSS_MARKER)
+    if (
+        process.returncode
+        or not found
+        or any(marker in output for marker in ERROR_MARKERS)
+    ):
+        sys.exit(f"{os.path.basename(script)} {' '.join(argv)[:200]} failed:\n{output}")
+    return elapsed, int(peak_rss)
+
+
+def stage_times(trace_path: str) -> dict[str, float]:
+    """Seconds spent in every stage of a --profile trace."""
+    with open(trace_path, "r", encoding="utf-8") as fh:
+        events = json.load(fh)["traceEvents"]
+    stages = {}
+    for event in events:
+        stages[event["name"]] = stages.get(event["name"], 0) + event["dur"] / 1e6
+    return stages
+
+
+def measure(
+    benchmark: str,
+    script: str,
+    argv: list[str],
+    cwd: str,
+    images: int,
+    resolution: tuple[int, int],
+    args: argparse.Namespace,
+) -> dict:
+    """Run the script --warmup then --repeat times, and summarize the timed runs."""
+    for _ in range(args.warmup):
+        run_script(script, argv, cwd)
+    trace_path = os.path.abspath(os.path.join(cwd, "bench-profile.json"))
+    runs = []
+    for _ in range(args.repeat):
+        elapsed, peak_rss = run_script(script, [*argv, f"--profile={trace_path}"], cwd)
+        runs.append((elapsed, peak_rss, stage_times(trace_path)))
+    median = statistics.median(elapsed for elapsed, _, _ in runs)
+    stages = {
+        name: round(statistics.median(run[2].get(name, 0) for run in runs), 6)
+        for name in runs[0][2]
+    }
+    result = {
+        "benchmark": benchmark,
+        "images": images,
+        "resolution": "{}x{}".format(*resolution),
+        "runs_s": [round(elapsed, 6) for elapsed, _, _ in runs],
+        "median_s": round(median, 6),
+        "min_s": round(min(elapsed for elapsed, _, _ in runs), 6),
+        "images_per_s": round(images / median, 3),
+        "peak_rss_mib": round(max(rss for _, rss, _ in runs) / 1024**2, 1),
+        "stages_s": stages,
+    }
+    if "render" in stages:
+        # Entries written by gen.py, once the metadata of every image is read
+        result["entries_per_s"] = round(images / max(stages["render"], 1e-9), 1)
+    print_result(result)
+    return result
+
+
+def print_header():
+    print(
+        f"{'Benchmark':<18} {'Images':>7} {'Resolution':>10} {'Median s':>9} "
+        f"{'Images/s':>10} {'Peak MiB':>9}  Slowest stages"
+    )
+
+
+def print_result(result: dict):
+    slowest = sorted(result["stages_s"].items(), key=lambda stage: -stage[1])[:3]
+    print(
+        f"{result['benchmark']:<18} {result['images']:>7} {result['resolution']:>10} "
+        f"{result['median_s']:>9.3f} {result['images_per_s']:>10.1f} "
+        f"{result['peak_rss_mib']:>9.1f}  "
+        + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in slowest)
+        + (
+            f", {result['entries_per_s']:.0f} entries/s"
+            if "entries_per_s" in result
+            else ""
+        )
+    )
+
+
+def gen_benchmarks(args: argparse.Namespace) -> list[dict]:
+    results = []
+    resolution = args.resolutions[0]
+    selected = [name for name in GEN_BENCHMARKS if name in args.benchmarks]
+    if not selected:
+        return results
+    script = os.path.join(current_path, "gen.py")
+    for count in args.images:
+        directory = make_corpus(
+            os.path.join(args.corpus_dir, "gen-{}-{}x{}".format(count, *resolution)),
+            count,
+            resolution,
+            args.seed,
+            derivatives=True,
+        )
+        os.makedirs(os.path.join(directory, "out"), exist_ok=True)
+        names = sorted(os.listdir(os.path.join(directory, BASEDIR)))
+        # Every image in a random order, by the digits of its name
+        filters = [name[4:9] for name in names if name.startswith("_BEN")]
+        random.Random(args.seed).shuffle(filters)
+        for benchmark in selected:
+            argv = [
+                "-l",
+                "local",
+                "-b",
+                BASEDIR,
+                "-t",
+                TEMPLATE,
+                "-o",
+                f"out/{benchmark}.html",
+                "--force",
+                "-q",
+                *GEN_BENCHMARKS[benchmark],
+                *args.gen_args.split(),
+            ]
+            if benchmark == "filter-order":
+                argv += ["-i", ",".join(filters)]
+            results.append(
+                measure(benchmark, script, argv, directory, count, resolution, args)
+            )
+    return results
+
+
+def resize_benchmarks(args: argparse.Namespace) -> list[dict]:
+    results = []
+    if "resize" not in args.benchmarks:
+        return results
+    script = os.path.join(current_path, "resize.py")
+    for resolution in args.resolutions:
+        directory = make_corpus(
+            os.path.join(
+                args.corpus_dir,
+                "resize-{}-{}x{}".format(args.resize_images, *resolution),
+            ),
+            args.resize_images,
+            resolution,
+            args.seed,
+            derivatives=False,
+        )
+        for backend in args.backends:
+            argv = [
+                "-b",
+                BASEDIR,
+                "--force",
+                "--backend",
+                backend,
+                "-j",
+                str(args.jobs),
+            ]
+            results.append(
+                measure(
+                    f"resize-{backend}",
+                    script,
+                    argv,
+                    directory,
+                    args.resize_images,
+                    resolution,
+                    args,
+                )
+            )
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=current_path,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+
+def compare(old_path: str, results: list[dict]):
+    """Print how much faster every benchmark got since the old results."""
+    with open(old_path, "r", encoding="utf-8") as fh:
+        old_results = {
+            (result["benchmark"], result["images"], result["resolution"]): result
+            for result in json.load(fh)["results"]
+        }
+    print(
+        f"\n{'Benchmark':<18} {'Images':>7} {'Resolution':>10} "
+        f"{'Before s':>9} {'After s':>9} {'Speedup':>8}"
+    )
+    for result in results:
+        key = (result["benchmark"], result["images"], result["resolution"])
+        if key not in old_results:
+            continue
+        before = old_results[key]["median_s"]
+        print(
+            f"{result['benchmark']:<18} {result['images']:>7} {result['resolution']:>10} "
+            f"{before:>9.3f} {result['median_s']:>9.3f} "
+            f"{before / result['median_s']:>7.2f}x"
+        )
+
+
+def main(sys_args=sys.argv[1:]):
+    args = parser.parse_args(sys_args)
+    if Image is None:
+        parser.error("Install Pillow to generate the corpora")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    print_header()
+    results = gen_benchmarks(args) + resize_benchmarks(args)
+    save_json(
+        args.output,
+        {
+            "version": 1,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "machine": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "memory_mib": resize.physical_memory() // 1024**2,
+            },
+            "settings": {
+                **vars(args),
+                "resolutions": ["{}x{}".format(*size) for size in args.resolutions],
+            },
+            "results": results,
+        },
+    )
+    print("Wrote the results to", args.output)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
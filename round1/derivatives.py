@@ -0,0 +1,327 @@
+"""Where the resized copies of every full size image are located.
+
+resize.py makes these derivatives and gen.py links to them, both use the
+registry and path conventions defined here.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from typing import NamedTuple
+
+PREFIX_ORDER_REGEX = re.compile(r"^__(\d+)_(.*)")
+
+# Written by resize.py --hashed-names next to the thumbnails, read by gen.py
+MANIFEST_FILENAME = ".derivatives_manifest.json"
+CONTENT_HASHES_FILENAME = ".content_hashes.json"
+# Hex digits of the hash in the name of a derivative
+HASH_LENGTH = 8
+
+
+def remove_file_order(path: str) -> str:
+    """Remove the user-specified order from a filename."""
+    return (
+        os.path.dirname(path)
+        + "/"
+        + PREFIX_ORDER_REGEX.sub(r"\2", os.path.basename(path))
+    )
+
+
+def get_file_order(path: str) -> int | float:
+    """Get the user-specified order for a file."""
+    match = PREFIX_ORDER_REGEX.match(os.path.basename(path))
+    if not match:
+        return float("inf")
+    return int(match.groups()[0])
+
+
+def file_info(path: str) -> tuple[str, int, int]:
+    """Basename of the real path, size and mtime_ns of an existing file."""
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    return os.path.basename(real_path), stat.st_size, stat.st_mtime_ns
+
+
+def scan_directory(directory: str) -> dict[str, tuple[str, int, int] | None]:
+    """file_info() of every file in a folder by name, None for anything else.
+
+    One listing, and one stat() per file instead of a realpath() and a stat().
+    Names are in the order of glob("*"), which skips hidden files as well.
+    """
+    listing = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_symlink():
+                        listing[entry.name] = file_info(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        listing[entry.name] = (
+                            entry.name,
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                        )
+                    else:
+                        listing[entry.name] = None
+                except FileNotFoundError:
+                    # Broken symbolic link, or deleted since the listing
+                    listing[entry.name] = None
+    except FileNotFoundError:
+        pass
+    return listing
+
+
+class Layout(NamedTuple):
+    """The sub-folders of the full size images and of their derivatives."""
+
+    max_resolution_dir: str = "max_resolution/"
+    thumbnail_dir: str = "potato/"
+    smaller_dir: str = "potato/"
+    # Derivatives are named after a hash of their original, see MANIFEST_FILENAME
+    hashed_names: bool = False
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "Layout":
+        return cls(
+            args.max_resolution_sub_dir,
+            args.thumbnail_sub_dir,
+            args.smaller_sub_dir,
+            args.hashed_names,
+        )
+
+    def to_argv(self) -> list[str]:
+        """The command line arguments of add_layout_arguments() for this layout."""
+        argv = [
+            f"--max-resolution-sub-dir={self.max_resolution_dir}",
+            f"--thumbnail-sub-dir={self.thumbnail_dir}",
+            f"--smaller-sub-dir={self.smaller_dir}",
+        ]
+        if self.hashed_names:
+            argv.append("--hashed-names")
+        return argv
+
+    def to_dir(self, img: str, to_dir: str) -> str:
+        """The path of img inside the thumbnail or smaller folder, without its order."""
+        sub_dir = self.thumbnail_dir if to_dir == "thumbnail" else self.smaller_dir
+        return remove_file_order(img.replace(self.max_resolution_dir, sub_dir))
+
+    def manifest_path(self, basedir: str) -> str:
+        return os.path.join(self.to_dir(basedir, "thumbnail"), MANIFEST_FILENAME)
+
+    def paths(self, img: str) -> dict[str, str]:
+        """The full size image and the plain names of all its derivatives."""
+        paths = {"fullsize": img}
+        for derivative in DERIVATIVES:
+            paths[derivative.name] = derivative.target(img, self)
+        return paths
+
+
+DEFAULT_LAYOUT = Layout()
+
+
+def add_layout_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--max-resolution-sub-dir",
+        "--max-resolution-sub-folder",
+        help="Sub-folder where all the full size images are located.",
+        default=DEFAULT_LAYOUT.max_resolution_dir,
+    )
+    parser.add_argument(
+        "--thumbnail-sub-dir",
+        help="Sub-folder where all the thumbnail size images are located.",
+        default=DEFAULT_LAYOUT.thumbnail_dir,
+    )
+    parser.add_argument(
+        "--smaller-sub-dir",
+        help="Sub-folder where all the less-than-fullsize images are located.",
+        default=DEFAULT_LAYOUT.smaller_dir,
+    )
+    parser.add_argument(
+        "--hashed-names",
+        help="Name derivatives after a hash of their original and settings, "
+        "e.g. _FEL0970.3fa9c2d1_1500.jpg, so they can be cached forever. "
+        f"resize.py lists the names in {MANIFEST_FILENAME}, where gen.py finds them.",
+        action="store_true",
+    )
+
+
+def sha256_file(fh) -> str:
+    # Reads in chunks, large originals are not loaded into memory
+    return hashlib.file_digest(fh, "sha256").hexdigest()
+
+
+class ContentHashes:
+    """Hashes of files, only computed again when their size or mtime change."""
+
+    def __init__(self, path: str, hash_file=sha256_file):
+        self.path = path
+        self.hash_file = hash_file
+        # Real path: [size, mtime_ns, hex digest]
+        self.hashes: dict[str, list] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                self.hashes = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def digest(self, path: str) -> str:
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        cached = self.hashes.get(real_path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        with open(real_path, "rb") as fh:
+            digest = self.hash_file(fh)
+        self.hashes[real_path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def forget_missing(self):
+        """Drop the hashes of files that were deleted."""
+        self.hashes = {
+            path: cached for path, cached in self.hashes.items() if os.path.exists(path)
+        }
+
+    def save(self):
+        save_json(self.path, self.hashes)
+
+
+class DerivativeManifest:
+    """The hashed name of every derivative, by its plain name.
+
+    Plain names are relative to the folder of the manifest, a hashed name is
+    the basename of a file in the same folder as its plain name.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self.names: dict[str, str] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                self.names = json.load(fh)
+        except FileNotFoundError:
+            pass
+
+    def resolve(self, plain: str) -> str | None:
+        name = self.names.get(os.path.relpath(plain, self.directory))
+        return name and os.path.join(os.path.dirname(plain), name)
+
+    def add(self, plain: str, hashed: str):
+        assert os.path.dirname(plain) == os.path.dirname(hashed)
+        self.names[os.path.relpath(plain, self.directory)] = os.path.basename(hashed)
+
+    def keep(self, plains: set[str]):
+        """Remove the entries of every other plain name, e.g. of deleted originals."""
+        relative = {os.path.relpath(plain, self.directory) for plain in plains}
+        self.names = {
+            plain: name for plain, name in self.names.items() if plain in relative
+        }
+
+    def paths(self) -> set[str]:
+        """Every hashed derivative the manifest points to."""
+        return {
+            os.path.join(os.path.dirname(os.path.join(self.directory, plain)), name)
+            for plain, name in self.names.items()
+        }
+
+    def save(self):
+        save_json(self.path, self.names)
+
+
+def save_json(path: str, value):
+    """Replace the file at once, readers never see a partial file."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(value, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class Derivative(NamedTuple):
+    """A resized copy made from every full size image."""
+
+    # Used by gen.py to refer to this derivative
+    name: str
+    # Appended to the filename of the original
+    suffix: str
+    # Either the thumbnail or the smaller directory
+    to_dir: str
+    # 256x - Resize so that 256px is the width, the height shall be proportional
+    # x256 - Resize so that 256px is the height, the width shall be proportional
+    geometry: str
+    quality: int
+    # Remove EXIF and other metadata
+    strip: bool = False
+    options: tuple[str, ...] = ()
+    # Set by with_content_hash() for --hashed-names
+    content_hash: str = ""
+
+    def target(self, img: str, layout: Layout = DEFAULT_LAYOUT) -> str:
+        plain = layout.to_dir(img, self.to_dir)
+        if not self.content_hash:
+            return plain + self.suffix
+        # _FEL0970.jpg becomes _FEL0970.3fa9c2d1_1500.jpg or _FEL0970.3fa9c2d1.jpg
+        stem, extension = os.path.splitext(plain)
+        return f"{stem}.{self.content_hash}{self.suffix or extension}"
+
+    def with_content_hash(self, digest: str) -> "Derivative":
+        """This derivative named after the digest of its original and the settings."""
+        content_hash = hashlib.sha256(f"{digest} {self.fingerprint()}".encode())
+        return self._replace(content_hash=content_hash.hexdigest()[:HASH_LENGTH])
+
+    def command(self, img: str, layout: Layout = DEFAULT_LAYOUT) -> list[str]:
+        return [
+            "magick",
+            img,
+            "-auto-orient",
+            *(["-strip"] if self.strip else []),
+            "-quality",
+            str(self.quality),
+            "-resize",
+            self.geometry,
+            *self.options,
+            self.target(img, layout),
+        ]
+
+    def fingerprint(self) -> str:
+        """Changes whenever the command would produce a different file."""
+        return json.dumps(self._replace(content_hash="").command("{original}"))
+
+    def size(self) -> int:
+        """Approximate size in pixels, e.g. 900 for 900x900^ and 96 for x96"""
+        return int(re.search(r"\d+", self.geometry).group())
+
+
+WEBP_LOSSY = ("-define", "webp:lossless=false")
+DERIVATIVES = [
+    Derivative(
+        "thumbnail_optimized",
+        ".webp",
+        "thumbnail",
+        "x256",
+        78,
+        strip=True,
+        options=WEBP_LOSSY,
+    ),
+    Derivative(
+        "thumbnail_tiny",
+        "_tiny.webp",
+        "thumbnail",
+        "x96",
+        75,
+        strip=True,
+        options=WEBP_LOSSY,
+    ),
+    Derivative("thumbnail", "", "thumbnail", "x256", 78, strip=True),
+    Derivative("thumbnail_avif", ".avif", "thumbnail", "x256", 50, strip=True),
+    Derivative(
+        "evensmaller", "_900.webp", "smaller", "900x900^", 85, options=WEBP_LOSSY
+    ),
+    Derivative(
+        "smaller", "_1500.jpg", "smaller", "1500x1500^", 92, options=("-format", "jpg")
+    ),
+]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Resize the full size images and generate the HTML pages that display them.
+
+gallery.py resize, gallery.py gen and gallery.py upload are resize.py, gen.py
+and upload.py.
+gallery.py build does both for every page of a manifest in one process:
+the derivatives made by resize.py are handed straight to gen.py, which does
+not scan or verify them again.
+With --watch it keeps running, and when originals change only their
+derivatives are made and only the pages showing them generated again.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import gen
+import resize
+import upload
+import watch
+from derivatives import Layout
+
+build_parser = argparse.ArgumentParser(
+    prog="gallery.py build",
+    description="Resize the images of every page declared in a TOML manifest, "
+    "then generate the pages, all in one process. "
+    "Any other gen.py options given here apply to every page, "
+    "--force and --dry-run apply to resizing as well.",
+    parents=[gen.build_parser],
+    add_help=False,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+build_parser.add_argument(
+    "--no-resize",
+    help="Only generate the pages, like 'gen.py build'.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--backend",
+    help="See 'resize.py --help'.",
+    choices=list(resize.BACKENDS),
+    default="magick",
+)
+build_parser.add_argument(
+    "--pipeline",
+    help="See 'resize.py --help'.",
+    choices=["cascade", "separate"],
+    default="cascade",
+)
+build_parser.add_argument(
+    "--resize-jobs",
+    help="Maximum number of originals resized at the same time.",
+    type=int,
+    default=resize.parser.get_default("jobs"),
+)
+build_parser.add_argument(
+    "--max-memory",
+    help="Memory budget for resizing, see 'resize.py --help'.",
+    default=resize.parser.get_default("max_memory"),
+)
+build_parser.add_argument(
+    "--watch",
+    help="After building, keep watching the originals and templates, "
+    "and rebuild what shows the files that changed.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--watch-debounce",
+    help="Wait until no file changed for this many seconds before rebuilding, "
+    "so a batch export is rebuilt once.",
+    type=float,
+    default=1.0,
+)
+build_parser.add_argument(
+    "--poll-interval",
+    help="Look for changes every this many seconds instead of using inotify, "
+    "e.g. on network storage. 0 polls every second only where inotify is not available.",
+    type=float,
+    default=0,
+)
+
+COMMANDS = {
+    "resize": resize,
+    "gen": gen,
+    "build": None,
+    "upload": upload,
+}
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+parser.add_argument("command", choices=list(COMMANDS))
+parser.add_argument(
+    "arguments",
+    help="Run 'gallery.py COMMAND --help' for the arguments of every command.",
+    nargs=argparse.REMAINDER,
+)
+
+
+def resize_page(
+    args: argparse.Namespace, layout: Layout, build_args: argparse.Namespace
+) -> list[str]:
+    """resize.py arguments for the images of a page."""
+    argv = [
+        f"--basedir={gen.get_basedir(args)}",
+        *layout.to_argv(),
+        f"--backend={build_args.backend}",
+        f"--pipeline={build_args.pipeline}",
+        f"--jobs={build_args.resize_jobs}",
+        f"--max-memory={build_args.max_memory}",
+    ]
+    if args.force:
+        argv.append("--force")
+    if args.dry_run:
+        argv.append("--dry-run")
+    return argv
+
+
+def resize_pages(
+    pages: list[argparse.Namespace],
+    build_args: argparse.Namespace,
+    context: gen.BuildContext,
+    changed: dict[str, list[str]] | None = None,
+):
+    """Resize the images of every page, or only the changed ones by basedir."""
+    resized = set()
+    for args in pages:
+        basedir = gen.get_basedir(args)
+        layout = Layout.from_args(args)
+        if build_args.no_resize or (basedir, layout) in resized:
+            continue
+        resized.add((basedir, layout))
+        if changed is None:
+            # The same paths gen.py will look for, from the same scan
+            images = context.glob(basedir)
+        else:
+            images = [path for path in changed.get(basedir, []) if os.path.isfile(path)]
+            if not images:
+                continue
+        gen.logger.info("Resizing %s images of %s", len(images), basedir)
+        resize_args = resize.parser.parse_args(resize_page(args, layout, build_args))
+        made = resize.resize_all(resize_args, layout, images, context.profiler)
+        context.add_verified(made)
+
+
+def build(build_args: argparse.Namespace, extra_args: list[str]):
+    """Resize the images of every page, then generate them sharing one BuildContext."""
+    pages = gen.load_manifest(build_args, extra_args)
+    if not pages:
+        return
+    context = gen.BuildContext(
+        max(args.jobs for args in pages),
+        gen.Profiler(enabled=bool(build_args.profile)),
+    )
+    try:
+        resize_pages(pages, build_args, context)
+        gen.generate_pages(pages, context)
+        if build_args.watch:
+            context.save()
+            watch_pages(pages, build_args, context)
+    finally:
+        context.close()
+    gen.report_profile(context.profiler, build_args.profile)
+
+
+def affected_pages(
+    pages: list[argparse.Namespace],
+    originals: dict[str, list[str]],
+    templates: set[str],
+) -> list[argparse.Namespace]:
+    """The pages showing any of the changed originals, or using a changed template."""
+    affected = []
+    for args in pages:
+        images = originals.get(gen.get_basedir(args), [])
+        if args.image_list and images:
+            # Deleted originals match too, only their names are compared
+            images = gen.select_images(images, gen.parse_filters(args.image_list))
+        if images or args.html_template in templates:
+            affected.append(args)
+    return affected
+
+
+def watch_pages(
+    pages: list[argparse.Namespace],
+    build_args: argparse.Namespace,
+    context: gen.BuildContext,
+):
+    """Rebuild the pages whenever their originals or templates change, until Ctrl+C.
+
+    The metadata of the originals that did not change stays in context.
+    """
+    basedirs = sorted({gen.get_basedir(args) for args in pages})
+    templates = {args.html_template for args in pages if args.html_template}
+    directories = basedirs + sorted(
+        {os.path.dirname(path) or "." for path in templates} - set(basedirs)
+    )
+    watcher = watch.open_watcher(directories, build_args.poll_interval)
+    gen.logger.info(
+        "Watching %s with %s, press Ctrl+C to stop",
+        ", ".join(directories),
+        type(watcher).__name__,
+    )
+    # The changes of a rebuild that failed, built again with the next changes
+    retry = set()
+    try:
+        while True:
+            changed = watch.wait_for_changes(watcher, build_args.watch_debounce)
+            changed |= retry
+            start = time.perf_counter()
+            originals = {}
+            for basedir in basedirs:
+                if basedir in changed:
+                    # Events were lost, everything in the folder may have changed
+                    context.forget({basedir})
+                    originals[basedir] = context.glob(basedir)
+                else:
+                    originals[basedir] = sorted(
+                        path for path in changed if os.path.dirname(path) == basedir
+                    )
+            normalized = {os.path.normpath(path) for path in changed}
+            changed_templates = {
+                path for path in templates if os.path.normpath(path) in normalized
+            }
+            forgotten = set(changed) | changed_templates
+            for args in pages:
+                layout = Layout.from_args(args)
+                for path in originals.get(gen.get_basedir(args), []):
+                    forgotten.update(layout.paths(path).values())
+            context.forget(forgotten)
+
+            rebuilt = affected_pages(pages, originals, changed_templates)
+            try:
+                resize_pages(pages, build_args, context, originals)
+                gen.generate_pages(rebuilt, context)
+                context.save()
+            except Exception:
+                # e.g. a half exported JPEG, which is complete by the next change
+                gen.logger.error(
+                    "Rebuild failed, retrying with the next change", exc_info=True
+                )
+                context.forget(forgotten)
+                retry = changed
+                continue
+            retry = set()
+            gen.logger.info(
+                "Rebuilt %s of %s pages for %s changed files in %.2fs",
+                len(rebuilt),
+                len(pages),
+                len(changed),
+                time.perf_counter() - start,
+            )
+    finally:
+        watcher.close()
+
+
+def main(sys_args=sys.argv[1:]):
+    args = parser.parse_args(sys_args)
+    if args.command == "build":
+        build_args, extra_args = build_parser.parse_known_args(args.arguments)
+        if not resize.BACKENDS[build_args.backend].available:
+            build_parser.error(
+                f"Install the Python package for the {build_args.backend} backend"
+            )
+        gen.run_with_logging(build_args, lambda: build(build_args, extra_args))
+        return
+    module = COMMANDS[args.command]
+    module.parser.prog = f"gallery.py {args.command}"
+    module.main(args.arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,25 +6,62 @@ Good luck!
 import argparse
 import base64
 import datetime
+import functools
 import glob
+import hashlib
+import html
+import json
 import logging
 import os.path
 import random
 import re
+import struct
 import sys
-from collections import defaultdict
+import threading
+import time
+import tomllib
+import urllib.parse
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import StrEnum
 
 try:
-    import gzip
+    import zlib
 except ImportError:
-    gzip = None
+    zlib = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import derivatives
+import placeholders
+import tinyexif
+from profiling import Profiler
+from derivatives import (
+    DerivativeManifest,
+    Layout,
+    add_layout_arguments,
+    get_file_order,
+    remove_file_order,
+    scan_directory,
+)
 
 # PYTHONPATH add external/exifpy/
 current_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(current_path, "external/exifpy"))
-# TODO write your own exif library for jpg + png
-import exifread
+# Fallback for image formats tinyexif does not understand
+try:
+    import exifread
+except ImportError:
+    exifread = None
 
 logger = logging.getLogger(__name__)
 
@@ -62,8 +99,62 @@ EXIF_TAG_CONVERTERS = {
 }
 POSSIBLE_EXIF_TAGS = list(EXIF_TAG_CONVERTERS.keys())
 
+BUILD_STATE_FILENAME = ".gen_build_state.json"
+PROFILE_FILENAME = "gen-profile.json"
+# These arguments do not change the generated HTML
+NON_OUTPUT_ARGUMENTS = {
+    "html_output",
+    "jobs",
+    "exif_cache",
+    "no_exif_cache",
+    "rebuild_exif_cache",
+    "build_state",
+    "force",
+    "dry_run",
+    "verbose",
+    "quiet",
+    "profile",
+}
+
+# Replaced in the --html-template
+OUTPUT_MARKER = "<!-- gen.py output -->"
+PAGINATION_MARKER = "<!-- gen.py pagination -->"
+CUSTOM_CSS_MARKER = "/* Flexbox gallery custom CSS from gen.py */"
+
+# --output-format: what is written before, between and after the entries
+OUTPUT_FORMATS = {
+    "html": ("", "\n", ""),
+    # A data island in the template, its LightGallery opens them as dynamicEl
+    "json": (
+        '<script type="application/json" class="__gallery_data">[',
+        ",\n",
+        "]</script>",
+    ),
+    # A data file for Hugo, without the template
+    "hugo": ('{"images": [\n', ",\n", "\n]}\n"),
+}
+
+EXIF_CACHE_FILENAME = ".gen_exif_cache.sqlite3"
+# Bump this whenever get_tags or EXIF_TAG_CONVERTERS change their output
+EXIF_CACHE_VERSION = 4
+# A file added within this long of a listing may not change the mtime of its folder
+RACY_LISTING_NS = 2 * 10**9
+
+
+
+def parse_size(value: str) -> int:
+    """Bytes from sizes like 48KiB, 14K or 20000."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)i?B?", value.strip(), re.I)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** (" KMG".index(unit.upper() or " ")))
+
+
 parser = argparse.ArgumentParser(
-    description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    description=__doc__,
+    epilog="Run 'gen.py build MANIFEST' to generate several pages at once.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
 )
 parser.add_argument(
     "--default-artist",
@@ -91,6 +182,15 @@ parser.add_argument(
     help="Use this template file. Will replace the string '<!-- gen.py output -->' in the template file with special HTML. LightGallery ($) or ViewerJS recommended, but suitable for non-JS browsers as well.",
     default="",
 )
+parser.add_argument(
+    "--output-format",
+    help="Write the images as anchors, as a JSON data island the template shows "
+    "with LightGallery's dynamicEl, or as a Hugo data file, "
+    "e.g. -o data/gallery.json for {{ range site.Data.gallery.images }}. "
+    "With --html-output -, json and hugo print one JSON object per line.",
+    choices=OUTPUT_FORMATS,
+    default="html",
+)
 parser.add_argument(
     "--basedir",
     "-b",
@@ -129,21 +229,23 @@ parser.add_argument(
     help="How many images to encode in base64 for ultimate resilience against network errors. This can significantly increase the size of the HTML and ruins HTML caching.",
 )
 parser.add_argument(
-    "--max-resolution-sub-dir",
-    "--max-resolution-sub-folder",
-    help="Sub-folder where all the full size images are located.",
-    default="max_resolution/",
+    "--inline-budget",
+    type=parse_size,
+    help="Inline the first images, in display order, until this many bytes are spent, "
+    "instead of --hardcoded-count of them, e.g. 12KiB keeps the top of the page "
+    "within the first TCP round trip (an initial congestion window of 10 segments, about 14KiB). "
+    "0 to use --hardcoded-count.",
+    default=0,
 )
 parser.add_argument(
-    "--thumbnail-sub-dir",
-    help="Sub-folder where all the thumbnail size images are located.",
-    default="potato/",
-)
-parser.add_argument(
-    "--smaller-sub-dir",
-    help="Sub-folder where all the less-than-fullsize images are located.",
-    default="potato/",
+    "--placeholder",
+    help="What is inlined: the tiny WebP thumbnail in base64, "
+    "or a box of its dominant color, with a BlurHash the template turns into a blurry preview. "
+    "color and blurhash take a few dozen bytes per image and need Pillow.",
+    choices=placeholders.KINDS,
+    default="webp",
 )
+add_layout_arguments(parser)
 parser.add_argument(
     "--order-from-filter",
     help="If using --include-images or --filter-images, respect that order for the final output.",
@@ -184,11 +286,83 @@ parser.add_argument(
     help=f"Comma separated list of EXIF tag names to show in the image description, title, and alt text. Possible values: {POSSIBLE_EXIF_TAGS}",
     default="Image Make,Image Model,EXIF FocalLength",
 )
+parser.add_argument(
+    "--page-size",
+    type=int,
+    help="Only put this many images in the page, 0 for all of them. "
+    "The others go to numbered fragments, which the template loads on scroll, "
+    f"and to numbered static pages, linked from a <noscript> replacing '{PAGINATION_MARKER}'.",
+    default=0,
+)
+parser.add_argument(
+    "--compress-level",
+    type=int,
+    help="gzip level of the .gz copy written next to every page and fragment, "
+    "for servers that send precompressed files as is.",
+    choices=range(1, 10),
+    default=9,
+)
+parser.add_argument(
+    "--brotli-quality",
+    type=int,
+    help="Quality of the .br copy written next to every page and fragment "
+    "if brotli is installed. 11 is the smallest, but takes seconds on large pages.",
+    choices=range(0, 12),
+    default=9,
+)
+parser.add_argument(
+    "--no-sidecars",
+    help="Do not write .gz and .br copies, and remove the ones of the generated pages.",
+    action="store_true",
+)
 parser.add_argument(
     "--custom-css",
     help="Custom CSS to insert into template.",
     default="",
 )
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    help="Number of threads verifying files and reading image metadata and thumbnails. Useful for network storage. The output does not depend on this.",
+    default=min(32, (os.cpu_count() or 1) + 4),
+)
+parser.add_argument(
+    "--exif-reader",
+    help="Use the built-in header-only EXIF reader, falling back to exifread for other formats, or always use exifread.",
+    choices=["tinyexif", "exifread"],
+    default="tinyexif",
+)
+parser.add_argument(
+    "--exif-cache",
+    help=f"EXIF metadata cache file. Defaults to {EXIF_CACHE_FILENAME} inside --basedir.",
+    default="",
+)
+parser.add_argument(
+    "--no-exif-cache",
+    help="Always read EXIF metadata from the full size images.",
+    action="store_true",
+)
+parser.add_argument(
+    "--rebuild-exif-cache",
+    help="Discard the EXIF metadata cache and read every image again.",
+    action="store_true",
+)
+parser.add_argument(
+    "--build-state",
+    help=f"Hashes of the inputs of every generated page, used to skip unchanged pages. Defaults to {BUILD_STATE_FILENAME} next to --html-output.",
+    default="",
+)
+parser.add_argument(
+    "--force",
+    help="Regenerate the page even if its inputs did not change.",
+    action="store_true",
+)
+parser.add_argument(
+    "--dry-run",
+    help="Only log which pages would be regenerated and why.",
+    action="store_true",
+)
 parser.add_argument(
     "--verbose",
     "-v",
@@ -201,6 +375,53 @@ parser.add_argument(
     help="Log only errors.",
     action="store_true",
 )
+parser.add_argument(
+    "--profile",
+    help="Log the calls, wall and CPU time and bytes read of every stage, "
+    "and write them to this Chrome trace-event file.",
+    nargs="?",
+    const=PROFILE_FILENAME,
+    default="",
+)
+
+build_parser = argparse.ArgumentParser(
+    prog="gen.py build",
+    description="Generate all the pages declared in a TOML manifest in one process, "
+    "reading every image and template only once. "
+    "Any other gen.py options given here apply to every page.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+build_parser.add_argument(
+    "manifest",
+    help="TOML file with a [defaults] table and one [[pages]] table per page. "
+    "Keys are gen.py option names without the leading --, "
+    "lists are joined with commas. See portfolios.toml",
+)
+build_parser.add_argument(
+    "--output-dir",
+    help="Relative html-output paths are relative to this folder. "
+    "Overrides the output-dir of the manifest.",
+    default=None,
+)
+build_parser.add_argument(
+    "--verbose",
+    "-v",
+    help="Log more information.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--quiet",
+    "-q",
+    help="Log only errors.",
+    action="store_true",
+)
+build_parser.add_argument(
+    "--profile",
+    help="See 'gen.py --help'.",
+    nargs="?",
+    const=PROFILE_FILENAME,
+    default="",
+)
 
 
 def parse_csv(thelist: str) -> list[str]:
@@ -215,10 +436,501 @@ def filter_match(haystack, filter_) -> bool:
     return filter_ in haystack
 
 
-def get_tags(img_filepath: str) -> dict[str, str]:
-    """Extract EXIF image metadata from a given file."""
+class FilterMatcher:
+    """Aho-Corasick automaton over all the --filter-images substrings.
+
+    Finds the first filter, in command line order, contained in a string with
+    one pass over its characters, no matter how many filters there are.
+    Equivalent to the first filtr for which filter_match(haystack, filtr).
+    """
+
+    def __init__(self, filters: list[str]):
+        self.filters = filters
+        self.goto: list[dict[str, int]] = [{}]
+        # Lowest filter index matching at each state, including its suffixes
+        self.first: list[int | None] = [None]
+        for index, filtr in enumerate(filters):
+            state = 0
+            for char in filtr:
+                if char not in self.goto[state]:
+                    self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.first.append(None)
+                state = self.goto[state][char]
+            if self.first[state] is None:
+                self.first[state] = index
+
+        # Breadth first, so failure links always point to finished states
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                if state:
+                    fallback = self.fail[state]
+                    while fallback and char not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[child] = self.goto[fallback].get(char, 0)
+                self.first[child] = min_index(
+                    self.first[child], self.first[self.fail[child]]
+                )
+
+    def first_match(self, haystack: str) -> int | None:
+        """Index of the first filter found in haystack, None if there is none."""
+        state = 0
+        first = self.first[0]
+        for char in haystack:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            first = min_index(first, self.first[state])
+        return first
+
+
+def min_index(a: int | None, b: int | None) -> int | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def read_base64(path: str) -> str:
+    with open(path, "rb") as fh:
+        return base64.b64encode(fh.read()).decode()
+
+
+WEBP_DATA_URL_PREFIX = "data:image/webp;base64,"
+# No placeholder is shorter, it is the one of a 1x1 image
+MIN_PLACEHOLDER_BYTES = len(placeholders.svg_data_url(1, 1, "#000000"))
+
+
+def base64_webp_size(size: int) -> int:
+    """Bytes of the data URL of a WebP file of this size."""
+    return len(WEBP_DATA_URL_PREFIX) + 4 * -(-size // 3)
+
+
+def srcset(url: str, size: tuple[int, int] | None) -> str:
+    """A srcset candidate with the width of the image, if it is known."""
+    return f"{url} {size[0]}w" if size else url
+
+
+def size_attributes(size: tuple[int, int] | None) -> str:
+    """The width and height of an <img>, or sizes for the w descriptors of srcset()"""
+    if not size:
+        return ""
+    width, height = size
+    return f' sizes="{width}px" width="{width}" height="{height}"'
+
+
+def inline_thumbnail(
+    path: str, kind: str, read_placeholder
+) -> tuple[str, dict[str, str]]:
+    """The src of an embedded tiny thumbnail, and the other attributes of its <img>"""
+    if kind == "webp":
+        return WEBP_DATA_URL_PREFIX + read_base64(path), {}
+    placeholder = read_placeholder(path, kind)
+    src = placeholders.svg_data_url(
+        placeholder["width"], placeholder["height"], placeholder["color"]
+    )
+    if kind == "blurhash":
+        return src, {"data-blurhash": placeholder["blurhash"]}
+    return src, {}
+
+
+def escape_attribute(value: str) -> str:
+    """For a double quoted attribute value, where < and > need no escaping."""
+    return value.replace("&", "&amp;").replace('"', "&quot;")
+
+
+def minify(markup: str) -> str:
+    """Join the lines of a template without their indentation.
+
+    Done once when the template is loaded, the values filled in per image
+    are single lines.
+    """
+    return "".join(line.strip() + " " for line in markup.split("\n")).strip()
+
+
+# Filled with format_map() for every image, the values are escaped first
+# data-fullsize - link to fullsize image, for viewerjs
+# onerror - without the <source>, the embedded thumbnail is shown
+ENTRY_HTML = minify("""
+    <!-- {name} -->
+    <a
+        class="__gallery_anchor"
+        data-sub-html="{caption}"
+        href="{fullsize}"
+        data-src="{smaller}"
+        data-srcset="{srcset}"
+        data-download-url="{fullsize}"
+    >
+        <picture>
+            <source type="image/avif" srcset="{avif_srcset}"{thumbnail_attributes}>
+            <source type="image/webp" srcset="{webp_srcset}"{thumbnail_attributes}>
+            <img
+                title="{alt_text}"
+                src="{src}"{placeholder_attributes}
+                srcset="{thumbnail_srcset}"{thumbnail_attributes}{loading}
+                decoding="async"
+                onerror="this.onerror=null;this.parentNode.replaceChildren(this);this.srcset=this.src"
+                data-fullsize="{fullsize}" >
+        </picture>
+    </a>""")
+# The subHtml of LightGallery, HTML in the data-sub-html attribute
+CAPTION_HTML = minify("""
+    <h4>{title}</h4>
+    <p>Exposure: {important_info} <i>({details})</i></p>""")
+
+
+def hash_json(value) -> str:
+    """Short, stable hash of any JSON-serializable value."""
+    encoded = json.dumps(value, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def write_if_changed(path: str, data: str) -> bool:
+    """Atomically replace the file, but only if its contents would change.
+
+    Keeps the mtime of unchanged files, so caches stay valid.
+    """
+    encoded = data.encode()
+    try:
+        with open(path, "rb") as fh:
+            if fh.read() == encoded:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as fh:
+        fh.write(encoded)
+    os.replace(tmp_path, path)
+    return True
+
+
+# Precompressed copies of the pages, served as is by static hosts
+SIDECAR_SUFFIXES = {"gzip": ".gz", "brotli": ".br"}
+
+
+class PageWriter:
+    """Writes a page as it is generated, instead of keeping it in memory.
+
+    The page goes to a temporary file that only replaces the output if its
+    contents changed, like write_if_changed(). The gzip size is measured on
+    the same chunks, which also make the .gz and .br sidecars when asked.
+    A path of - only measures the size.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compress_level: int | None = 9,
+        sidecars: bool = False,
+        brotli_quality: int = 9,
+    ):
+        self.path = path
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        self.fh = None if path == "-" else open(self.tmp_path, "wb")
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.gzip = None
+        self.gzip_size = 0
+        self.brotli = None
+        self.changed = False
+        # Precompressed copies, only replaced if they changed like the page
+        self.sidecars: dict[str, PageWriter] = {}
+        if compress_level is None or not zlib:
+            return
+        self.gzip = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+        if sidecars and self.fh:
+            self.sidecars["gzip"] = PageWriter(path + SIDECAR_SUFFIXES["gzip"], None)
+            if brotli:
+                self.brotli = brotli.Compressor(quality=brotli_quality)
+                self.sidecars["brotli"] = PageWriter(
+                    path + SIDECAR_SUFFIXES["brotli"], None
+                )
+
+    def write(self, text: str):
+        self.write_bytes(text.encode())
+
+    def write_bytes(self, data: bytes):
+        self.size += len(data)
+        self.digest.update(data)
+        if self.fh:
+            self.fh.write(data)
+        if self.gzip:
+            self.write_compressed("gzip", self.gzip.compress(data))
+        if self.brotli:
+            self.write_compressed("brotli", self.brotli.process(data))
+
+    def write_compressed(self, encoding: str, data: bytes):
+        if encoding == "gzip":
+            self.gzip_size += len(data)
+        if encoding in self.sidecars:
+            self.sidecars[encoding].write_bytes(data)
+
+    def same_as_output(self) -> bool:
+        try:
+            if os.path.getsize(self.path) != self.size:
+                return False
+            with open(self.path, "rb") as fh:
+                existing = hashlib.file_digest(fh, "sha256")
+            return existing.digest() == self.digest.digest()
+        except FileNotFoundError:
+            return False
+
+    def close(self, failed: bool = False):
+        if self.gzip:
+            self.write_compressed("gzip", self.gzip.flush())
+        if self.brotli:
+            self.write_compressed("brotli", self.brotli.finish())
+        for sidecar in self.sidecars.values():
+            sidecar.close(failed)
+        if not self.fh:
+            return
+        self.fh.close()
+        if failed or self.same_as_output():
+            # Keeps the mtime of unchanged files, so caches stay valid
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+            self.changed = True
+        if self.gzip and not failed:
+            # A server would keep sending an outdated copy instead of the page
+            for encoding, suffix in SIDECAR_SUFFIXES.items():
+                if encoding not in self.sidecars and os.path.exists(self.path + suffix):
+                    logger.info("Removing %s", self.path + suffix)
+                    os.remove(self.path + suffix)
+
+
+class PaginatedOutput:
+    """Writes the entries of a page between the head and tail of the template.
+
+    With a page size, only the first entries go to the page. The others go to
+    numbered fragments, appended by the template on scroll, and to numbered
+    static pages for browsers without JavaScript.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        head: str,
+        tail: str,
+        page_size: int,
+        count: int,
+        compress_level: int = 9,
+        sidecars: bool = False,
+        separator: str = "\n",
+        brotli_quality: int = 9,
+    ):
+        self.head = head
+        self.tail = tail
+        self.page_size = page_size
+        self.page_count = max(1, -(-count // page_size)) if page_size else 1
+        self.stem, self.extension = os.path.splitext(path)
+        # all.html, all-2.html, all-3.html...
+        self.page_paths = [path] + [
+            f"{self.stem}-{number}{self.extension}"
+            for number in range(2, self.page_count + 1)
+        ]
+        # None, all-2.fragment.html, all-3.fragment.html...
+        self.fragment_paths = [None] + [
+            f"{self.stem}-{number}.fragment{self.extension}"
+            for number in range(2, self.page_count + 1)
+        ]
+        self.compress_level = compress_level
+        self.sidecars = sidecars
+        self.separator = separator
+        self.brotli_quality = brotli_quality
+        self.page = 0
+        self.page_entries = 0
+        self.writers: list[PageWriter] = []
+        self.closed: list[PageWriter] = []
+
+    def navigation(self, page: int) -> str:
+        """Links to every static page, and the fragments for the main page."""
+        if self.page_count == 1:
+            return ""
+        links = " ".join(
+            (
+                f"<b>{number + 1}</b>"
+                if number == page
+                else f'<a href="{self.url(path)}">{number + 1}</a>'
+            )
+            for number, path in enumerate(self.page_paths)
+        )
+        if page:
+            return f'<nav class="__gallery_pages">{links}</nav>'
+        fragments = " ".join(self.url(path) for path in self.fragment_paths[1:])
+        return (
+            f'<nav class="__gallery_pages" data-fragments="{fragments}">'
+            f"<noscript>{links}</noscript></nav>"
+        )
+
+    def url(self, path: str) -> str:
+        """Pages and fragments are next to each other."""
+        return urllib.parse.quote(os.path.basename(path))
+
+    def start_page(self):
+        navigation = self.navigation(self.page)
+        paths = [self.page_paths[self.page]]
+        if self.fragment_paths[self.page]:
+            paths.append(self.fragment_paths[self.page])
+        self.writers = [
+            PageWriter(path, self.compress_level, self.sidecars, self.brotli_quality)
+            for path in paths
+        ]
+        self.writers[0].write(self.head.replace(PAGINATION_MARKER, navigation))
+        self.page_entries = 0
+
+    def end_page(self, failed: bool = False):
+        if not failed:
+            self.writers[0].write(
+                self.tail.replace(PAGINATION_MARKER, self.navigation(self.page))
+            )
+        for writer in self.writers:
+            writer.close(failed)
+        self.closed += self.writers
+
+    def write_entry(self, entry: str):
+        if self.page_size and self.page_entries == self.page_size:
+            self.end_page()
+            self.page += 1
+            self.start_page()
+        for writer in self.writers:
+            if self.page_entries:
+                writer.write(self.separator)
+            writer.write(entry)
+        self.page_entries += 1
+
+    def remove_stale_pages(self):
+        """Remove the pages after the last page, found from their fragments.
+
+        Pages without a fragment were not written by gen.py, and are kept.
+        """
+        pattern = re.compile(rf"-(\d+)\.fragment{re.escape(self.extension)}")
+        for fragment in glob.glob(
+            f"{glob.escape(self.stem)}-*.fragment{glob.escape(self.extension)}"
+        ):
+            match = pattern.fullmatch(fragment[len(self.stem) :])
+            if match and int(match.group(1)) > self.page_count:
+                page = f"{self.stem}-{match.group(1)}{self.extension}"
+                logger.info("Removing %s and %s", page, fragment)
+                for path in (page, fragment):
+                    for suffix in ["", *SIDECAR_SUFFIXES.values()]:
+                        if os.path.exists(path + suffix):
+                            os.remove(path + suffix)
+
+    @property
+    def changed(self) -> bool:
+        return any(writer.changed for writer in self.closed)
+
+    @property
+    def paths(self) -> list[str]:
+        """Every file written: the pages, fragments and their sidecars."""
+        return [
+            path
+            for writer in self.closed
+            for path in [writer.path]
+            + [sidecar.path for sidecar in writer.sidecars.values()]
+        ]
+
+    @property
+    def gzip_size(self) -> int | None:
+        """What a browser with JavaScript downloads: the page and its fragments."""
+        if not zlib:
+            return None
+        return sum(
+            writer.gzip_size
+            for writer in self.closed
+            if writer.path not in self.page_paths[1:]
+        )
+
+    def __enter__(self) -> "PaginatedOutput":
+        self.start_page()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_page(failed=exc_type is not None)
+        if exc_type is None and self.page_paths[0] != "-":
+            self.remove_stale_pages()
+
+
+class BuildState:
+    """Hashes of the inputs of every page generated in one folder.
+
+    Pages are only regenerated when one of their inputs changed: the gen.py
+    code, its arguments, the image list, the metadata, the template, or the
+    size and mtime of any derivative file, or when a file they wrote is missing.
+    Pages are keyed by the real path of their output.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages: dict[str, dict[str, str]] = {}
+        self.changed = False
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                self.pages = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning("Ignoring invalid build state %s", path)
+
+    def changes(self, output: str, inputs: dict[str, str]) -> list[str]:
+        """Why the output needs to be regenerated, empty if it is up to date."""
+        previous = self.pages.get(os.path.realpath(output))
+        if previous is None:
+            return ["new page"]
+        # Pages, fragments and sidecars, relative to the folder of the output
+        directory = os.path.dirname(output) or "."
+        missing = [
+            path
+            for path in previous.get("outputs", [os.path.basename(output)])
+            if not os.path.exists(os.path.join(directory, path))
+        ]
+        if missing:
+            return [f"{', '.join(missing)} missing"]
+        return [
+            f"{name} changed"
+            for name, value in inputs.items()
+            if previous.get(name) != value
+        ]
+
+    def update(self, output: str, inputs: dict[str, str], paths: list[str]):
+        directory = os.path.dirname(output) or "."
+        self.pages[os.path.realpath(output)] = {
+            **inputs,
+            "outputs": sorted(os.path.relpath(path, directory) for path in paths),
+        }
+        self.changed = True
+
+    def save(self):
+        if self.changed:
+            write_if_changed(
+                self.path, json.dumps(self.pages, indent=1, sort_keys=True)
+            )
+
+
+def read_all_tags(img_filepath: str, reader: str = "tinyexif") -> dict:
+    """Read raw EXIF tags, only decoding the image headers when possible."""
     with open(img_filepath, "rb") as fh:
-        all_tags = exifread.process_file(fh)
+        if reader == "tinyexif":
+            try:
+                return tinyexif.process_file(fh)
+            except (ValueError, struct.error) as err:
+                logger.debug("tinyexif failed for %s: %s", img_filepath, err)
+                fh.seek(0)
+        if exifread is None:
+            logger.warning("Install exifread to read EXIF from %s", img_filepath)
+            return {}
+        return exifread.process_file(fh, extract_thumbnail=False)
+
+
+def get_tags(img_filepath: str, reader: str = "tinyexif") -> dict[str, str]:
+    """Extract EXIF image metadata from a given file."""
+    all_tags = read_all_tags(img_filepath, reader)
     tags = defaultdict(lambda: "")
     for tag, value in all_tags.items():
         if tag not in EXIF_TAG_CONVERTERS:
@@ -236,44 +948,544 @@ def get_tags(img_filepath: str) -> dict[str, str]:
     return tags
 
 
-def get_exif_datetime(path: str) -> datetime.datetime | int:
-    return get_tags(path).get("Image DateTime", 0)
+def read_image_size(img_filepath: str) -> tuple[int, int] | None:
+    """Width and height of a derivative, from its header."""
+    with open(img_filepath, "rb") as fh:
+        try:
+            return tinyexif.image_size(fh)
+        except (ValueError, struct.error) as err:
+            logger.warning("Unable to read the size of %s: %s", img_filepath, err)
+            return None
 
 
-PREFIX_ORDER_REGEX = re.compile(r"^__(\d+)_(.*)")
+EXIF_DATETIME_FORMAT = "%Y:%m:%d %H:%M:%S"
 
 
-def remove_file_order(path: str) -> str:
-    """Remove the user-specified order from a filename."""
-    return (
-        os.path.dirname(path)
-        + "/"
-        + PREFIX_ORDER_REGEX.sub(r"\2", os.path.basename(path))
-    )
+def get_exif_datetime(tags: dict[str, str]) -> datetime.datetime | None:
+    """Parse the EXIF datetime, which looks like 2024:12:31 23:59:59"""
+    value = tags.get("Image DateTime", "").strip(" \x00")
+    try:
+        return datetime.datetime.strptime(value, EXIF_DATETIME_FORMAT)
+    except ValueError:
+        return None
 
 
-def get_file_order(path: str) -> int | float:
-    """Get the user-specified order for a file."""
-    match = PREFIX_ORDER_REGEX.match(os.path.basename(path))
-    if not match:
-        return float("inf")
-    return int(match.groups()[0])
+class ExifCache:
+    """Persistent EXIF metadata cache, an SQLite file next to the full size images.
+
+    Entries are keyed by (realpath, size, mtime_ns), so a warm rebuild only
+    needs one stat() per image and never opens the originals. The tags are
+    also keyed by the --exif-reader that read them.
+    The --placeholder of the tiny thumbnails and the dimensions of the
+    derivatives are cached the same way, and the names in the derivative
+    folders by the mtime of the folder.
+    Edited, replaced or deleted images are evicted when the cache is closed.
+    """
+
+    def __init__(self, db_path: str, rebuild: bool = False, reader: str = "tinyexif"):
+        self.db_path = db_path
+        self.reader = reader
+        # Shared by the --jobs threads, all queries hold self.lock
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if rebuild or version != EXIF_CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS exif")
+            self.db.execute("DROP TABLE IF EXISTS placeholders")
+            self.db.execute("DROP TABLE IF EXISTS sizes")
+            self.db.execute("DROP TABLE IF EXISTS listings")
+            self.db.execute(f"PRAGMA user_version = {EXIF_CACHE_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS exif ("
+            "path TEXT, reader TEXT, size INTEGER, mtime_ns INTEGER, tags TEXT, "
+            "PRIMARY KEY (path, reader))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS placeholders ("
+            "path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, placeholder TEXT, "
+            "PRIMARY KEY (path, kind))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sizes ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "width INTEGER, height INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, listing TEXT)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get_tags(self, img_filepath: str, reader: str | None = None) -> dict[str, str]:
+        """Same as get_tags, but only parses the file if the cache entry is stale."""
+        reader = reader or self.reader
+        path = os.path.realpath(img_filepath)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, tags FROM exif WHERE path = ? AND reader = ?",
+                (path, reader),
+            ).fetchone()
+            if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                self.hits += 1
+                tags = defaultdict(lambda: "")
+                tags.update(json.loads(row[2]))
+                return tags
+            self.misses += 1
+        tags = get_tags(path, reader)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?, ?)",
+                (path, reader, stat.st_size, stat.st_mtime_ns, json.dumps(tags)),
+            )
+        return tags
+
+    def get_placeholder(self, thumbnail_path: str, kind: str) -> dict:
+        """Same as placeholders.read_placeholder, cached like the EXIF tags."""
+        path = os.path.realpath(thumbnail_path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, placeholder FROM placeholders "
+                "WHERE path = ? AND kind = ?",
+                (path, kind),
+            ).fetchone()
+            if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                return json.loads(row[2])
+        placeholder = placeholders.read_placeholder(path, kind)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO placeholders VALUES (?, ?, ?, ?, ?)",
+                (path, kind, stat.st_size, stat.st_mtime_ns, json.dumps(placeholder)),
+            )
+        return placeholder
+
+    def get_image_size(self, img_filepath: str) -> tuple[int, int] | None:
+        """Same as read_image_size, cached like the EXIF tags."""
+        path = os.path.realpath(img_filepath)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, width, height FROM sizes WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                return row[2:] if row[2] is not None else None
+        size = read_image_size(path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, *(size or (None, None))),
+            )
+        return size
+
+    def get_listing(self, directory: str) -> dict[str, tuple[str, int, int] | None]:
+        """Same as scan_directory, only listed again when the folder changed.
+
+        Only the names are cached, rewriting a file in place does not change
+        the mtime of its folder. Every file is stat() again.
+        """
+        path = os.path.realpath(directory)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mtime_ns, listing FROM listings WHERE path = ?", (path,)
+            ).fetchone()
+        if row and row[0] == mtime_ns:
+            listing = {}
+            # Name: basename of its real path, None for anything but a file
+            for name, real_name in json.loads(row[1]).items():
+                listing[name] = None
+                if real_name is None:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                listing[name] = (real_name, stat.st_size, stat.st_mtime_ns)
+            return listing
+        listing = scan_directory(directory)
+        if time.time_ns() - mtime_ns > RACY_LISTING_NS:
+            names = {name: info and info[0] for name, info in listing.items()}
+            with self.lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO listings VALUES (?, ?, ?)",
+                    (path, mtime_ns, json.dumps(names)),
+                )
+        return listing
+
+    def evict_stale(self) -> int:
+        """Delete entries for images that were modified or no longer exist."""
+        evicted = 0
+        stale = []
+        for path, mtime_ns in self.db.execute("SELECT path, mtime_ns FROM listings"):
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    stale.append((path,))
+            except FileNotFoundError:
+                stale.append((path,))
+        self.db.executemany("DELETE FROM listings WHERE path = ?", stale)
+        evicted += len(stale)
+        for table in ("exif", "placeholders", "sizes"):
+            stale = []
+            for path, size, mtime_ns in self.db.execute(
+                f"SELECT path, size, mtime_ns FROM {table}"
+            ):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    stale.append((path,))
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    stale.append((path,))
+            self.db.executemany(f"DELETE FROM {table} WHERE path = ?", stale)
+            evicted += len(stale)
+        return evicted
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        evicted = self.evict_stale()
+        self.db.commit()
+        self.db.close()
+        logger.debug(
+            "EXIF cache %s: %s hits, %s misses, %s evicted",
+            self.db_path,
+            self.hits,
+            self.misses,
+            evicted,
+        )
+
+
+def open_exif_cache(args: argparse.Namespace, basedir: str) -> ExifCache | None:
+    """Open the EXIF cache requested by the command line arguments, if any."""
+    if args.no_exif_cache:
+        return None
+    if sqlite3 is None:
+        logger.warning("sqlite3 is not available, EXIF metadata will not be cached")
+        return None
+    db_path = args.exif_cache or os.path.join(basedir, EXIF_CACHE_FILENAME)
+    try:
+        return ExifCache(
+            db_path, rebuild=args.rebuild_exif_cache, reader=args.exif_reader
+        )
+    except sqlite3.Error as err:
+        logger.warning("Unable to open EXIF cache %s: %s", db_path, err)
+        return None
+
+
+def get_readable_basename(path: str) -> str:
+    """The filename shown to users and matched against filters."""
+    return os.path.basename(remove_file_order(path))
+
+
+def select_images(all_images: list[str], filters: list[str]) -> dict[str, int]:
+    """Keep only the images matching any filter, before doing any per-image I/O.
+
+    Returns the index of the first matching filter for every selected image,
+    in the same order as all_images.
+    """
+    matcher = FilterMatcher(filters)
+    selected = {}
+    for path in all_images:
+        first = matcher.first_match(get_readable_basename(path))
+        if first is not None:
+            selected[path] = first
+    return selected
+
+
+@dataclass
+class ImageRecord:
+    """Metadata of one full size image, extracted once per run."""
+
+    path: str
+    tags: dict[str, str]
+    datetime: datetime.datetime | None
+
+    @classmethod
+    def read(cls, path: str, read_tags=get_tags) -> "ImageRecord":
+        tags = read_tags(path)
+        return cls(path=path, tags=tags, datetime=get_exif_datetime(tags))
+
+    def exif_order(self) -> datetime.datetime:
+        """Sort key for --order-from-exif, images without a datetime go first."""
+        return self.datetime or datetime.datetime.min
+
+    def prefix_order(self) -> int | float:
+        """Sort key for --order-from-prefix."""
+        return get_file_order(self.path)
+
+
+def generator_hash() -> str:
+    """Hash of the code generating the HTML, a new version rebuilds every page.
+
+    Besides gen.py, that is the derivative names, the placeholders, the EXIF
+    readers and their versions.
+    """
+    digest = hashlib.sha256()
+    for path in (
+        __file__,
+        derivatives.__file__,
+        placeholders.__file__,
+        tinyexif.__file__,
+    ):
+        with open(path, "rb") as fh:
+            digest.update(fh.read())
+    if exifread:
+        digest.update(str(getattr(exifread, "__version__", "")).encode())
+    return digest.hexdigest()[:16]
+
+
+class BuildContext:
+    """Work shared by all the pages generated in one process.
+
+    Every folder is listed once, and every image, derivative and template is
+    read or verified once, no matter how many pages use it.
+    """
+
+    def __init__(self, jobs: int, profiler: Profiler | None = None):
+        self.profiler = profiler or Profiler()
+        # Keeps the output order, only the file reads run in parallel
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.exif_caches: dict[str, ExifCache | None] = {}
+        # Folder: its scan_directory(), see listing()
+        self.listings: dict[str, dict[str, tuple[str, int, int] | None]] = {}
+        # (--exif-reader, path): its record
+        self.records: dict[tuple[str, str], ImageRecord] = {}
+        self.image_sizes: dict[str, tuple[int, int] | None] = {}
+        # Path of a verified file: (basename of its real path, size, mtime_ns)
+        self.verified: dict[str, tuple[str, int, int]] = {}
+        self.inline_thumbnails: dict[tuple[str, str], Future] = {}
+        self.templates: dict[str, str] = {}
+        self.build_states: dict[str, BuildState] = {}
+        self.manifests: dict[str, DerivativeManifest] = {}
+        self.generator = generator_hash()
+
+    def exif_cache(self, args: argparse.Namespace, basedir: str) -> ExifCache | None:
+        if basedir not in self.exif_caches:
+            self.exif_caches[basedir] = open_exif_cache(args, basedir)
+        return self.exif_caches[basedir]
+
+    def read_tags_for(self, args: argparse.Namespace, basedir: str):
+        """Return the EXIF reader for this basedir, cached if possible."""
+        exif_cache = self.exif_cache(args, basedir)
+        if exif_cache:
+            return lambda path: exif_cache.get_tags(path, args.exif_reader)
+        return lambda path: get_tags(path, args.exif_reader)
+
+    def read_size_for(self, args: argparse.Namespace, basedir: str):
+        """Return the derivative size reader for this basedir, cached if possible."""
+        exif_cache = self.exif_cache(args, basedir)
+        if exif_cache:
+            return exif_cache.get_image_size
+        return read_image_size
+
+    def read_placeholder_for(self, args: argparse.Namespace, basedir: str):
+        """Return the --placeholder reader for this basedir, cached if possible."""
+        exif_cache = self.exif_cache(args, basedir)
+        if exif_cache:
+            return exif_cache.get_placeholder
+        return placeholders.read_placeholder
+
+    def glob(self, basedir: str) -> list[str]:
+        """The same paths as glob.glob(f"{basedir}/*"), listing basedir once."""
+        if basedir not in self.listings:
+            with self.profiler.stage("scan", basedir=basedir):
+                self.listing(basedir)
+        return [f"{basedir}/{name}" for name in self.listings[basedir]]
+
+    def listing(
+        self, directory: str, exif_cache: ExifCache | None = None
+    ) -> dict[str, tuple[str, int, int] | None]:
+        """file_info() of the files of a folder by name, listed once per run."""
+        if directory not in self.listings:
+            if exif_cache:
+                self.listings[directory] = exif_cache.get_listing(directory)
+            else:
+                self.listings[directory] = scan_directory(directory)
+        return self.listings[directory]
+
+    def read_records(
+        self, paths: list[str], read_tags, reader: str
+    ) -> dict[str, ImageRecord]:
+        """Parse every image exactly once, sorting and HTML generation share this"""
+        unread = [path for path in paths if (reader, path) not in self.records]
+        with self.profiler.stage("metadata", images=len(unread)):
+            self.records.update(
+                zip(
+                    [(reader, path) for path in unread],
+                    self.executor.map(
+                        lambda path: ImageRecord.read(path, read_tags), unread
+                    ),
+                )
+            )
+        return {path: self.records[reader, path] for path in paths}
+
+    def read_sizes(
+        self, paths: list[str], read_size
+    ) -> dict[str, tuple[int, int] | None]:
+        """Width and height of every derivative, read once like the records."""
+        unread = list(dict.fromkeys(p for p in paths if p not in self.image_sizes))
+        with self.profiler.stage("sizes", files=len(unread)):
+            self.image_sizes.update(zip(unread, self.executor.map(read_size, unread)))
+        return {path: self.image_sizes[path] for path in paths}
+
+    def add_verified(self, infos: dict[str, tuple[str, int, int]]):
+        """Trust file_info() of files that were just written, e.g. by resize.py"""
+        self.verified.update(infos)
+
+    def paths_for(self, basedir: str, layout: Layout):
+        """Return a function giving the full size image and derivatives of an image.
+
+        With --hashed-names, the names are looked up in the manifest of resize.py
+        """
+        if not layout.hashed_names:
+            return layout.paths
+        manifest_path = layout.manifest_path(basedir)
+        if manifest_path not in self.manifests:
+            self.manifests[manifest_path] = DerivativeManifest(manifest_path)
+        manifest = self.manifests[manifest_path]
+
+        def hashed_paths(image_path: str) -> dict[str, str]:
+            paths = layout.paths(image_path)
+            for name, plain in paths.items():
+                if name == "fullsize":
+                    continue
+                paths[name] = manifest.resolve(plain)
+                assert paths[name], f"{plain} is not in {manifest_path}, run resize.py"
+            return paths
+
+        return hashed_paths
+
+    def verify(
+        self, image_paths: list[str], all_filepaths, exif_cache: ExifCache | None = None
+    ) -> dict[str, list[str]]:
+        """Check that all the files of every image exist locally.
+
+        Every folder is listed once, see listing(), then every file is looked up
+        in the listing of its folder. All the missing files are reported at once.
+        Returns the verified basenames grouped by type of file.
+        """
+        verified_paths = defaultdict(list)
+        missing = []
+        with self.profiler.stage("verify", images=len(image_paths)):
+            for image_path in image_paths:
+                for name, file in all_filepaths(image_path).items():
+                    if file not in self.verified:
+                        directory, basename = os.path.split(file)
+                        info = self.listing(directory, exif_cache).get(basename)
+                        if info is None:
+                            missing.append(f"{name} {file}")
+                            continue
+                        self.verified[file] = info
+                    verified_paths[name].append(self.verified[file][0])
+        assert not missing, f"{len(missing)} files are missing, run resize.py:\n" + (
+            "\n".join(missing)
+        )
+        return verified_paths
+
+    def read_inline(self, path: str, kind: str, read_placeholder) -> Future:
+        """Start reading a thumbnail to embed in the background."""
+        if (path, kind) not in self.inline_thumbnails:
+            self.inline_thumbnails[path, kind] = self.executor.submit(
+                inline_thumbnail, path, kind, read_placeholder
+            )
+        return self.inline_thumbnails[path, kind]
+
+    def file_stats(self, files: list[str]) -> list[tuple[int, int]]:
+        """Size and mtime of files that were already verified."""
+        return [self.verified[file][1:] for file in files]
+
+    def build_state(self, path: str) -> BuildState:
+        if path not in self.build_states:
+            self.build_states[path] = BuildState(path)
+        return self.build_states[path]
+
+    def template(self, path: str) -> str:
+        if path not in self.templates:
+            with self.profiler.stage("template", template=path):
+                with open(path, "r", encoding="utf-8") as htmltemplate:
+                    self.templates[path] = htmltemplate.read()
+        return self.templates[path]
+
+    def forget(self, paths: set[str]):
+        """Read these files again when they are needed, e.g. after they changed.
+
+        Their folders are scanned again, and the manifests of --hashed-names
+        read again.
+        """
+        for path in paths:
+            self.listings.pop(os.path.dirname(path), None)
+            self.listings.pop(path, None)
+            self.image_sizes.pop(path, None)
+            self.verified.pop(path, None)
+            self.templates.pop(path, None)
+        self.records = {
+            key: record for key, record in self.records.items() if key[1] not in paths
+        }
+        self.inline_thumbnails = {
+            key: future
+            for key, future in self.inline_thumbnails.items()
+            if key[0] not in paths
+        }
+        self.manifests.clear()
+
+    def save(self):
+        """Write what is remembered for the next run, e.g. between --watch rebuilds"""
+        for build_state in self.build_states.values():
+            build_state.save()
+        for exif_cache in self.exif_caches.values():
+            if exif_cache:
+                exif_cache.commit()
+
+    def close(self):
+        self.executor.shutdown()
+        for build_state in self.build_states.values():
+            build_state.save()
+        for exif_cache in self.exif_caches.values():
+            if exif_cache:
+                exif_cache.close()
 
 
 def doit(args: argparse.Namespace):
     """Generate HTML given these arguments."""
+    context = BuildContext(args.jobs, Profiler(enabled=bool(args.profile)))
+    try:
+        generate_page(args, context)
+    finally:
+        context.close()
+    report_profile(context.profiler, args.profile)
+
+
+def report_profile(profiler: Profiler, trace_path: str):
+    """Log the --profile table and write the trace."""
+    if not profiler.enabled:
+        return
+    logger.info("Profile of every stage:\n%s", profiler.report())
+    profiler.write_trace(trace_path)
+    logger.info("Wrote the trace events to %s", trace_path)
+
+
+def get_basedir(args: argparse.Namespace) -> str:
+    """The --basedir as it prefixes the paths of all the files of the page."""
+    return "./" + os.path.relpath(args.basedir)
+
+
+def generate_page(args: argparse.Namespace, context: BuildContext):
+    """Generate the HTML of one page, reusing the work already done by context."""
     img_location: ImageLocation = ImageLocation(args.image_location.strip().upper())
 
     # the first X imgs will be base64 data encoded
     # hardcoded into the HTML itself
     total_base64: int | float = args.hardcoded_count
 
-    basedir = "./" + os.path.relpath(args.basedir)
-    max_resolution_dir = args.max_resolution_sub_dir
-    smaller_resolution_dir = args.smaller_sub_dir
-    thumbnail_resolution_dir = args.thumbnail_sub_dir
+    basedir = get_basedir(args)
+    layout = Layout.from_args(args)
     assert (
-        max_resolution_dir in basedir
+        layout.max_resolution_dir in basedir
     ), "Images must be contained in a subfolder named max_resolution/"
     filepath_root = args.pathroot
 
@@ -285,53 +1497,57 @@ def doit(args: argparse.Namespace):
         raise ValueError(f"Unknown image location! {img_location}")
     assert isinstance(desired_root, str), "What should the root URL be?"
 
-    to_thumbnail_dir = lambda path: path.replace(
-        max_resolution_dir, thumbnail_resolution_dir
-    )
-    to_smaller_dir = lambda path: path.replace(
-        max_resolution_dir, smaller_resolution_dir
-    )
-    def all_filepaths(fullsize_img: str) -> dict[str, str]:
-        return {
-        "fullsize": fullsize_img,
-        "thumbnail_tiny_optimized_filepath": to_thumbnail_dir(fullsize_img)
-        + "_tiny.webp",
-        "smaller": to_smaller_dir(fullsize_img) + "_1500.jpg",
-        "evensmaller": to_smaller_dir(fullsize_img) + "_900.webp",
-        "thumbnail": to_thumbnail_dir(fullsize_img),
-        "thumbnail_optimized": to_thumbnail_dir(fullsize_img) + ".webp",
-    }
-
     displayed_exif_tags = parse_tags_list(args.important_exif_tags)
     misc_exif_tags = parse_tags_list(args.other_exif_tags)
     overwrite_artist = args.overwrite_artist
     default_artist = args.default_artist
     html_output_location = args.html_output or "-"
-    html_template_location = args.html_template or "-"
+    html_template_location = args.html_template
     custom_css = args.custom_css
 
+    read_tags = context.read_tags_for(args, basedir)
+    # Verifying, sizes, inlining and the entry all need the paths of an image
+    all_filepaths = functools.cache(context.paths_for(basedir, layout))
+
     filters: list[str] = []
     if args.image_list:
         filters = parse_filters(args.image_list)
     logger.debug("Filter list: %s", filters)
 
-    all_images = glob.glob(f"{basedir}/*")
+    found_images = context.glob(basedir)
+    matched_filters = {}
+    all_images = found_images
+    if filters:
+        matched_filters = select_images(found_images, filters)
+        all_images = list(matched_filters)
+        logger.info(
+            "Skipped %s of %s images not matching the filters",
+            len(found_images) - len(all_images),
+            len(found_images),
+        )
+    records = context.read_records(all_images, read_tags, args.exif_reader)
+
     if args.shuffled_order:
+        if args.random_seed:
+            random.seed(args.random_seed)
         # Copy list
         sorted_images = all_images[:]
         random.shuffle(sorted_images)
     elif args.order_from_filter:
         logger.debug("Order from filter")
         assert filters, "Must pass a list of --filter-images!"
-        sorted_images = []
-        for filtr in filters:
-            for image in all_images:
-                if filter_match(image, filtr) and image not in sorted_images:
-                    sorted_images.append(image)
+        # Stable sort: images matching the same filter keep the glob order
+        sorted_images = list(sorted(all_images, key=matched_filters.__getitem__))
+        for image in sorted_images:
+            logger.debug("%s matched filter %s", image, filters[matched_filters[image]])
     elif args.order_from_exif:
-        sorted_images = list(sorted(all_images, key=get_exif_datetime))
+        sorted_images = list(
+            sorted(all_images, key=lambda path: records[path].exif_order())
+        )
     elif args.order_from_prefix:
-        sorted_images = list(sorted(all_images, key=get_file_order))
+        sorted_images = list(
+            sorted(all_images, key=lambda path: records[path].prefix_order())
+        )
     else:
         sorted_images = list(sorted(all_images))
 
@@ -342,154 +1558,406 @@ def doit(args: argparse.Namespace):
         
     # TODO assert that S3 url exists...?
     # check that all expected filenames exist locally
-    verified_paths = defaultdict(list)
-    for image_path in all_images:
-        for name, file in all_filepaths(image_path).items():
-            fpath = os.path.realpath(file)
-            assert os.path.exists(fpath), f"{name} is missing!"
-            verified_paths[name].append(os.path.basename(fpath))
+    verified_paths = context.verify(
+        all_images, all_filepaths, context.exif_cache(args, basedir)
+    )
     if verified_paths:
         for type_ in verified_paths:
             logger.debug("Verified %s paths exist: %s", type_, " ".join(verified_paths[type_]))
 
+    template = (
+        context.template(html_template_location) if html_template_location else ""
+    )
+    # Skip the page if none of its inputs changed since it was generated
+    with context.profiler.stage("inputs", page=html_output_location):
+        page_inputs = {
+            "generator": context.generator,
+            "arguments": hash_json(
+                {
+                    name: value
+                    for name, value in vars(args).items()
+                    if name not in NON_OUTPUT_ARGUMENTS
+                }
+            ),
+            "image list": hash_json(sorted_images),
+            "metadata": hash_json([records[path].tags for path in sorted_images]),
+            "template": hash_json(template),
+            "derivatives": hash_json(
+                context.file_stats(
+                    [
+                        file
+                        for path in sorted_images
+                        for file in all_filepaths(path).values()
+                    ]
+                )
+            ),
+        }
+        build_state = None
+        if html_output_location != "-":
+            build_state = context.build_state(
+                args.build_state
+                or os.path.join(
+                    os.path.dirname(html_output_location), BUILD_STATE_FILENAME
+                )
+            )
+            reasons = build_state.changes(html_output_location, page_inputs)
+            if args.force:
+                reasons.insert(0, "--force")
+            if not reasons:
+                logger.info("%s is up to date", html_output_location)
+                return
+            logger.info("Regenerating %s: %s", html_output_location, ", ".join(reasons))
+    if args.dry_run:
+        return
+
+    page_size = args.page_size
+    if page_size and html_output_location == "-":
+        logger.warning("--page-size needs an --html-output file")
+        page_size = 0
+    if page_size and args.output_format != "html":
+        logger.warning("--page-size needs --output-format html")
+        page_size = 0
+    if page_size:
+        # Only the first page embeds thumbnails
+        total_base64 = min(total_base64, page_size)
 
-    str_output = []
+    placeholder = args.placeholder
+    if placeholder != "webp" and not placeholders.available:
+        logger.warning(
+            "Install Pillow for --placeholder %s, inlining WebPs instead", placeholder
+        )
+        placeholder = "webp"
+    inline_budget: int | float = args.inline_budget or float("inf")
+    tiny_thumbnails = [all_filepaths(path)["thumbnail_tiny"] for path in sorted_images]
+    if args.inline_budget:
+        # Only read what may fit, the budget is spent in display order below
+        total_base64 = page_size or len(sorted_images)
+        if placeholder == "webp":
+            sizes = context.file_stats(tiny_thumbnails[:total_base64])
+            spent = 0
+            for index, (size, _) in enumerate(sizes):
+                spent += base64_webp_size(size)
+                if spent > inline_budget:
+                    total_base64 = index
+                    break
+        else:
+            total_base64 = min(
+                total_base64, args.inline_budget // MIN_PLACEHOLDER_BYTES
+            )
 
-    def output(line):
-        if html_output_location == "-":
-            print(line)
-        str_output.append(line)
+    # Dimensions of the derivatives in the markup, from their headers
+    image_sizes = context.read_sizes(
+        [
+            all_filepaths(path)[name]
+            for path in sorted_images
+            for name in ("thumbnail", "evensmaller", "smaller")
+        ],
+        context.read_size_for(args, basedir),
+    )
+
+    # Read the base64 thumbnails in parallel, they are all needed first
+    read_placeholder = context.read_placeholder_for(args, basedir)
+    inline_thumbnails = {}
+    with context.profiler.stage("inline thumbnails", page=html_output_location):
+        for index, tiny_thumbnail in enumerate(tiny_thumbnails):
+            if not (total_base64 and index < total_base64):
+                break
+            inline_thumbnails[index] = context.read_inline(
+                tiny_thumbnail, placeholder, read_placeholder
+            )
+        for future in inline_thumbnails.values():
+            future.result()
+    inline_bytes = 0
+    total_inlined = 0
 
     total_size = 0
     total_images = 0
-    for index, original_img_filepath in enumerate(sorted_images):
-        # ./Portfolio/img/
-        # https://s3.us-east-1.amazonaws.com/media.felina.art/img/s/Portfolio_2024-12/_FEL0970.jpg_1500.jpg
-        tags = get_tags(original_img_filepath)
-        logger.debug("EXIF Tags: %s", dict(tags))
-        # Convert filepath into the right name for URLs and thumbnails
-        root_img_filepath = remove_file_order(original_img_filepath)
-        logger.debug("Removed file order %s", root_img_filepath)
-        readable_basename = os.path.basename(root_img_filepath)
-        if filters and not any(
-            filter_match(readable_basename, filtr) for filtr in filters
-        ):
-            found_filter = [
-                filtr for filtr in filters if filter_match(readable_basename, filtr)
-            ]
-            logger.debug(
-                "Skipping %s due to filter %s", readable_basename, found_filter
-            )
-            continue
-        logger.debug("Processing image #%s: %s", total_images, readable_basename)
+    output_format = args.output_format
+    prefix, separator, suffix = OUTPUT_FORMATS[output_format]
+    head, tail = "", ""
+    if html_template_location and output_format != "hugo":
+        # Split once, the head and tail are written around the streamed entries
+        template = template.replace(CUSTOM_CSS_MARKER, custom_css)
+        head, found, tail = template.partition(OUTPUT_MARKER)
+        if not found:
+            logger.warning("%s has no %s", html_template_location, OUTPUT_MARKER)
+    with (
+        context.profiler.stage("render", page=html_output_location),
+        PaginatedOutput(
+            html_output_location,
+            head + prefix,
+            suffix + tail,
+            page_size,
+            len(sorted_images),
+            args.compress_level,
+            # Hugo would read the .gz and .br copies in data/ as well
+            sidecars=not args.no_sidecars and output_format != "hugo",
+            separator=separator,
+            brotli_quality=args.brotli_quality,
+        ) as output,
+    ):
+        render_start = time.perf_counter()
+        for index, original_img_filepath in enumerate(sorted_images):
+            # ./Portfolio/img/
+            # https://s3.us-east-1.amazonaws.com/media.felina.art/img/s/Portfolio_2024-12/_FEL0970.jpg_1500.jpg
+            tags = records[original_img_filepath].tags
+            logger.debug("EXIF Tags: %s", dict(tags))
+            # Convert filepath into the right name for URLs and thumbnails
+            root_img_filepath = remove_file_order(original_img_filepath)
+            logger.debug("Removed file order %s", root_img_filepath)
+            readable_basename = os.path.basename(root_img_filepath)
+            logger.debug("Processing image #%s: %s", total_images, readable_basename)
 
-        filepaths = all_filepaths(root_img_filepath)
-        urls = {name: path.replace(" ", "%20").replace(filepath_root, desired_root) for name, path in filepaths.items()}
+            # Derivatives are named after the original without its order, like the URL
+            filepaths = {
+                **all_filepaths(original_img_filepath),
+                "fullsize": root_img_filepath,
+            }
+            urls = {name: path.replace(" ", "%20").replace(filepath_root, desired_root) for name, path in filepaths.items()}
 
-        fullsize = urls["fullsize"]
-        # TODO ensure these filenames are the same used by resize.py
-        # TODO use shared functions or something....... all scripts in one file?
-        smaller = urls["smaller"]
-        evensmaller = urls["evensmaller"]
-        thumbnail = urls["thumbnail"]
-        thumbnail_optimized = urls["thumbnail_optimized"]
+            fullsize = urls["fullsize"]
+            smaller = urls["smaller"]
+            evensmaller = urls["evensmaller"]
+            thumbnail = urls["thumbnail"]
+            thumbnail_optimized = urls["thumbnail_optimized"]
+            thumbnail_avif = urls["thumbnail_avif"]
+            # Every thumbnail is resized to the same size, whatever its format
+            thumbnail_size = image_sizes[filepaths["thumbnail"]]
+            thumbnail_attributes = size_attributes(thumbnail_size)
+            evensmaller_size = image_sizes[filepaths["evensmaller"]]
+            smaller_size = image_sizes[filepaths["smaller"]]
 
-        if overwrite_artist:
-            artist = overwrite_artist
-        else:
-            artist = tags["Image Artist"] or default_artist
-        title = " ".join([readable_basename] + (["by", artist] if artist else []))
+            if overwrite_artist:
+                artist = overwrite_artist
+            else:
+                artist = tags.get("Image Artist") or default_artist
+            title = " ".join([readable_basename] + (["by", artist] if artist else []))
+
+            important_info = ""
+            if displayed_exif_tags:
+                important_info = " ".join(
+                    [tags.get(tag, "") for tag in displayed_exif_tags]
+                )
+                logger.debug("Important tags: %s", displayed_exif_tags)
+            details = " ".join([tags.get(tag, "") for tag in misc_exif_tags])
 
-        important_info = ""
-        if displayed_exif_tags:
-            important_info = " ".join(
-                [tags.get(tag, "") for tag in displayed_exif_tags]
+            alt_text = f"{title} (Exposure: {important_info})"
+            caption_html = CAPTION_HTML.format(
+                title=html.escape(title, quote=False),
+                important_info=html.escape(important_info, quote=False),
+                details=html.escape(details, quote=False),
             )
-            logger.debug("Important tags: %s", displayed_exif_tags)
-        details = " ".join([tags.get(tag, "") for tag in misc_exif_tags])
-
-        alt_text = f"{title} (Exposure: {important_info})"
-        # Avoid double quote in this string
-        caption_html = f"""
-        <h4>{title}</h4>
-        <p>Exposure: {important_info} <i>({details})</i></p>
-        """.strip().replace(
-            "\n", ""
-        )
 
-        tiny_base64 = None
-        embedded_thumbnail = f"{thumbnail}"
-        if total_base64 and index < total_base64:
-            with open(filepaths["thumbnail_tiny_optimized_filepath"], "rb") as tinythumb:
-                tiny_base64 = base64.b64encode(tinythumb.read()).decode()
-            embedded_thumbnail = f"data:image/webp;base64,{tiny_base64}"
-
-        # data-responsively-lazy - for lazy loading
-        # data-fullsize - link to fullsize image, for viewerjs
-        html = f"""
-            <!-- {readable_basename} -->
-            <a 
-                class="__gallery_anchor"
-                data-sub-html="{caption_html}"
-                href="{fullsize}"
-                data-src="{smaller}"
-                data-srcset="{evensmaller} 1100w, {smaller} 1600w"
-                data-download-url="{fullsize}"
-            >
-                <img
-                    title="{alt_text}"
-                    src="{embedded_thumbnail}"
-                    srcset="{thumbnail_optimized} 256w webp, {thumbnail} 256w"
-                    onerror="this.srcset=this.src"
-                    data-fullsize="{fullsize}" >
-            </a>"""
-        html = "".join(line.strip() + " " for line in html.split("\n")).strip()
-        logger.debug("Generated %s bytes for %s", len(html), readable_basename)
-        total_size += len(html) + 1  # plus newline
-        total_images += 1
-        output(html)
+            embedded_thumbnail = f"{thumbnail}"
+            inline_attributes = {}
+            # Images above the fold are the ones inlined
+            loading = ' loading="lazy"'
+            if index in inline_thumbnails:
+                src, attributes = inline_thumbnails[index].result()
+                placeholder_attributes = "".join(
+                    f' {name}="{value}"' for name, value in attributes.items()
+                )
+                inline_size = len(src) + len(placeholder_attributes)
+                if inline_bytes + inline_size > inline_budget:
+                    # The first image that does not fit ends the inlining
+                    inline_thumbnails.clear()
+                else:
+                    inline_bytes += inline_size
+                    total_inlined += 1
+                    embedded_thumbnail = src
+                    inline_attributes = attributes
+                    loading = ""
+
+            data_srcset = f"{srcset(evensmaller, evensmaller_size)}, {srcset(smaller, smaller_size)}"
+            if output_format == "html":
+                entry = ENTRY_HTML.format_map(
+                    {
+                        # A comment may not contain --, nor end the one around it
+                        "name": re.sub(
+                            "-(?=-)", "- ", html.escape(readable_basename, quote=False)
+                        ),
+                        "caption": escape_attribute(caption_html),
+                        "fullsize": escape_attribute(fullsize),
+                        "smaller": escape_attribute(smaller),
+                        "srcset": escape_attribute(data_srcset),
+                        "avif_srcset": escape_attribute(
+                            srcset(thumbnail_avif, thumbnail_size)
+                        ),
+                        "webp_srcset": escape_attribute(
+                            srcset(thumbnail_optimized, thumbnail_size)
+                        ),
+                        "thumbnail_attributes": thumbnail_attributes,
+                        "alt_text": escape_attribute(alt_text),
+                        "src": escape_attribute(embedded_thumbnail),
+                        "placeholder_attributes": "".join(
+                            f' {name}="{escape_attribute(value)}"'
+                            for name, value in inline_attributes.items()
+                        ),
+                        "thumbnail_srcset": escape_attribute(
+                            srcset(thumbnail, thumbnail_size)
+                        ),
+                        "loading": loading,
+                    }
+                )
+            elif output_format == "json":
+                # The fields of a LightGallery dynamicEl item, and of its thumbnail
+                item = {
+                    "src": smaller,
+                    "srcset": data_srcset,
+                    "thumb": thumbnail,
+                    "subHtml": caption_html,
+                    "downloadUrl": fullsize,
+                    "alt": alt_text,
+                    "sources": {
+                        "image/avif": srcset(thumbnail_avif, thumbnail_size),
+                        "image/webp": srcset(thumbnail_optimized, thumbnail_size),
+                    },
+                    "thumbSrcset": srcset(thumbnail, thumbnail_size),
+                }
+                if thumbnail_size:
+                    item["thumbWidth"], item["thumbHeight"] = thumbnail_size
+                if embedded_thumbnail != thumbnail:
+                    item["inline"] = embedded_thumbnail
+                    item["attributes"] = inline_attributes
+                # Nothing in the script element may look like a tag, e.g. </script>
+                entry = json.dumps(item, ensure_ascii=False).replace("<", "\\u003c")
+            else:
+                item = {
+                    "name": readable_basename,
+                    "title": title,
+                    "alt": alt_text,
+                    "artist": artist,
+                    "exposure": important_info,
+                    "details": details,
+                    "caption": caption_html,
+                    **urls,
+                    "sizes": {
+                        "thumbnail": thumbnail_size,
+                        "evensmaller": evensmaller_size,
+                        "smaller": smaller_size,
+                    },
+                }
+                if embedded_thumbnail != thumbnail:
+                    item["inline"] = embedded_thumbnail
+                entry = json.dumps(item, ensure_ascii=False)
+            logger.debug("Generated %s bytes for %s", len(entry), readable_basename)
+            total_size += len(entry) + len(separator)
+            total_images += 1
+            if html_output_location == "-":
+                print(entry)
+            output.write_entry(entry)
+        render_time = time.perf_counter() - render_start
 
     if total_images > 0:
         logger.info(
-            "Generated %s images, %s total bytes, average of %.2f bytes per image",
+            "Generated %s images in %.3fs, %.0f entries/s, "
+            "%s total bytes, average of %.2f bytes per image",
             total_images,
+            render_time,
+            total_images / max(render_time, 1e-9),
             total_size,
             total_size / total_images,
         )
     else:
         logger.warning("Empty image set? Filters too strict or wrong paths given.")
 
-    final_out = "\n".join(str_output)
-    if html_template_location:
-        with open(html_template_location, "r", encoding="utf-8") as htmltemplate:
-            final_out = (
-                htmltemplate.read()
-                .replace("/* Flexbox gallery custom CSS from gen.py */", custom_css)
-                .replace("<!-- gen.py output -->", final_out)
-            )
-    
+    if inline_bytes:
+        logger.info(
+            "Inlined %s thumbnails as %s, %s bytes%s",
+            total_inlined,
+            placeholder,
+            inline_bytes,
+            f" of the {args.inline_budget} bytes budget" if args.inline_budget else "",
+        )
+    if output.page_count > 1:
+        logger.info(
+            "Wrote %s images per page to %s pages", page_size, output.page_count
+        )
     if html_output_location != "-":
-        with open(html_output_location, "w", encoding="utf-8") as htmlout:
-            htmlout.write(final_out)
-    else:
-        # The output is printed to stdout as its generated
-        pass
+        if not output.changed:
+            logger.info("%s did not change", html_output_location)
+        build_state.update(html_output_location, page_inputs, output.paths)
 
-    if gzip and total_images > 0:
-        if final_out:
-            gzip_size = len(gzip.compress(final_out.encode()))
-        else:
-            gzip_size = len(gzip.compress("\n".join(str_output).encode()))
+    if output.gzip_size is not None and total_images > 0:
         logger.info(
             "Approximate GZIP size of all output: %s, savings of %.2f%%",
-            gzip_size,
-            100 * (1 - gzip_size / total_size),
+            output.gzip_size,
+            100 * (1 - output.gzip_size / total_size),
         )
 
 
+def manifest_to_argv(options: dict) -> list[str]:
+    """Convert a table of the build manifest to gen.py command line arguments."""
+    argv = []
+    for key, value in options.items():
+        if value is True:
+            argv.append(f"--{key}")
+        elif value is False:
+            continue
+        elif isinstance(value, list):
+            argv.append(f"--{key}=" + ",".join(map(str, value)))
+        else:
+            argv.append(f"--{key}={value}")
+    return argv
+
+
+def load_manifest(
+    build_args: argparse.Namespace, extra_args: list[str]
+) -> list[argparse.Namespace]:
+    """Parse the gen.py arguments of every page of the manifest."""
+    with open(build_args.manifest, "rb") as fh:
+        manifest = tomllib.load(fh)
+    output_dir = build_args.output_dir or manifest.get("output-dir", "")
+    defaults = manifest_to_argv(manifest.get("defaults", {}))
+    pages = [
+        parser.parse_args(defaults + manifest_to_argv(page) + extra_args)
+        for page in manifest.get("pages", [])
+    ]
+    if not pages:
+        logger.warning("No [[pages]] in %s", build_args.manifest)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        for args in pages:
+            if args.html_output not in ("", "-"):
+                args.html_output = os.path.join(output_dir, args.html_output)
+    return pages
+
+
+def build(build_args: argparse.Namespace, extra_args: list[str]):
+    """Generate every page of the manifest, sharing one BuildContext."""
+    pages = load_manifest(build_args, extra_args)
+    if not pages:
+        return
+    context = BuildContext(
+        max(args.jobs for args in pages), Profiler(enabled=bool(build_args.profile))
+    )
+    try:
+        generate_pages(pages, context)
+    finally:
+        context.close()
+    report_profile(context.profiler, build_args.profile)
+
+
+def generate_pages(pages: list[argparse.Namespace], context: BuildContext):
+    for args in pages:
+        logger.info("Generating %s", args.html_output)
+        logger.debug(args)
+        generate_page(args, context)
+
+
 def main(sys_args=sys.argv[1:]):
     """Parse arguments and run the code, with error logging."""
-    args = parser.parse_args(sys_args)
+    if sys_args and sys_args[0] == "build":
+        args, extra_args = build_parser.parse_known_args(sys_args[1:])
+        run = lambda: build(args, extra_args)
+    else:
+        args = parser.parse_args(sys_args)
+        run = lambda: doit(args)
+    run_with_logging(args, run)
+
+
+def run_with_logging(args: argparse.Namespace, run):
+    """Run after setting the log level from --verbose and --quiet, with error logging."""
     if args.quiet:
         logger.setLevel(logging.ERROR)
     elif args.verbose:
@@ -497,10 +1965,8 @@ def main(sys_args=sys.argv[1:]):
     else:
         logger.setLevel(logging.INFO)
     logger.debug(args)
-    if args.random_seed:
-        random.seed(args.random_seed)
     try:
-        doit(args)
+        run()
     except KeyboardInterrupt:
         logger.info("bye!")
     except Exception:
@@ -0,0 +1,127 @@
+"""Placeholders of a few dozen bytes, inlined by gen.py instead of tiny WebPs.
+
+Both are computed from the pixels of the tiny thumbnail: its dominant color,
+or a BlurHash (https://blurha.sh) that the template decodes into a blurry
+preview. The HTML gets an SVG of the size of the thumbnail filled with the
+color, so the layout is kept even without JavaScript.
+"""
+
+import math
+from urllib.parse import quote
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+KINDS = ["webp", "color", "blurhash"]
+# BlurHash components, more show more detail but make longer hashes
+X_COMPONENTS = 4
+Y_COMPONENTS = 3
+# The pixels are averaged into cosine components, a small image is enough
+BLURHASH_SIZE = 32
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+available = Image is not None
+
+
+def read_placeholder(path: str, kind: str) -> dict:
+    """Width, height and dominant color of an image, plus its BlurHash if asked."""
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+    # Most used color of a reduced palette, not the average of all colors
+    palette = img.quantize(colors=8)
+    _, index = max(palette.getcolors())
+    red, green, blue = palette.getpalette()[index * 3 : index * 3 + 3]
+    placeholder = {
+        "width": img.width,
+        "height": img.height,
+        "color": f"#{red:02x}{green:02x}{blue:02x}",
+    }
+    if kind == "blurhash":
+        img.thumbnail((BLURHASH_SIZE, BLURHASH_SIZE))
+        placeholder["blurhash"] = blurhash_encode(img.tobytes(), img.width, img.height)
+    return placeholder
+
+
+def svg_data_url(width: int, height: int, color: str) -> str:
+    """An image of this size filled with the color."""
+    svg = (
+        f"<svg xmlns='http://www.w3.org/2000/svg' width='{width}' height='{height}'>"
+        f"<rect width='100%' height='100%' fill='{color}'/></svg>"
+    )
+    return "data:image/svg+xml," + quote(svg, safe="='/:")
+
+
+def srgb_to_linear(value: int) -> float:
+    value = value / 255
+    if value <= 0.04045:
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value: float) -> int:
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def sign_pow(value: float, exponent: float) -> float:
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def encode83(value: int, length: int) -> str:
+    return "".join(
+        BASE83[value // 83 ** (length - digit) % 83] for digit in range(1, length + 1)
+    )
+
+
+def blurhash_encode(
+    pixels: bytes,
+    width: int,
+    height: int,
+    x_components: int = X_COMPONENTS,
+    y_components: int = Y_COMPONENTS,
+) -> str:
+    """The BlurHash of RGB pixels, row by row, as specified by the reference encoder."""
+    channels = [srgb_to_linear(value) for value in pixels]
+    linear = list(zip(channels[0::3], channels[1::3], channels[2::3]))
+    factors = []
+    for j in range(y_components):
+        cos_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            cos_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            normalisation = 1 if i == j == 0 else 2
+            red = green = blue = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = cos_x[x] * cos_y[y]
+                    r, g, b = linear[row + x]
+                    red += basis * r
+                    green += basis * g
+                    blue += basis * b
+            scale = normalisation / (width * height)
+            factors.append((red * scale, green * scale, blue * scale))
+
+    dc, ac = factors[0], factors[1:]
+    blurhash = encode83((x_components - 1) + (y_components - 1) * 9, 1)
+    max_value = 1.0
+    if ac:
+        actual_max = max(abs(value) for factor in ac for value in factor)
+        quantised = max(0, min(82, math.floor(actual_max * 166 - 0.5)))
+        max_value = (quantised + 1) / 166
+        blurhash += encode83(quantised, 1)
+    else:
+        blurhash += encode83(0, 1)
+    red, green, blue = map(linear_to_srgb, dc)
+    blurhash += encode83((red << 16) + (green << 8) + blue, 4)
+    for factor in ac:
+        red, green, blue = (
+            max(0, min(18, math.floor(sign_pow(value / max_value, 0.5) * 9 + 9.5)))
+            for value in factor
+        )
+        blurhash += encode83(red * 19 * 19 + green * 19 + blue, 2)
+    return blurhash
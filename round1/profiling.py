@@ -0,0 +1,138 @@
+"""Timers around the stages of a build, reported with --profile.
+
+Every stage counts its calls, wall time, CPU time and bytes read. The report
+is a table of the stages, and a trace in the Chrome trace-event format that
+chrome://tracing or https://ui.perfetto.dev open, one event per call.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+def bytes_read() -> int | None:
+    """Bytes read by this process so far, including from the page cache."""
+    try:
+        with open("/proc/self/io", "rb") as fh:
+            for line in fh:
+                if line.startswith(b"rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def cpu_time() -> float:
+    """CPU seconds of this process and of the children it waited for, e.g. magick"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Timer:
+    """Measures one call of a stage, also in a worker process."""
+
+    def __init__(self):
+        self.start_ns = time.time_ns()
+        self.wall = time.perf_counter()
+        self.cpu = cpu_time()
+        self.read = bytes_read()
+
+    def stop(self) -> dict:
+        """A measurement that can be sent back from a worker process."""
+        read = bytes_read()
+        return {
+            "start_ns": self.start_ns,
+            "wall": time.perf_counter() - self.wall,
+            "cpu": cpu_time() - self.cpu,
+            "bytes_read": read - self.read if read is not None else 0,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+        }
+
+
+@dataclass
+class StageTotals:
+    calls: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    bytes_read: int = 0
+
+
+class Profiler:
+    """Totals and trace events of every stage, does nothing unless enabled.
+
+    CPU time and bytes read are those of the whole process, so stages should
+    not overlap in one process. Jobs in worker processes are measured there.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.stages: dict[str, StageTotals] = {}
+        self.events: list[dict] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        if not self.enabled:
+            yield
+            return
+        timer = Timer()
+        try:
+            yield
+        finally:
+            self.record(name, timer.stop(), **args)
+
+    def record(self, name: str, measurement: dict, **args):
+        """Add one call of a stage, measured by a Timer."""
+        if not self.enabled:
+            return
+        with self.lock:
+            totals = self.stages.setdefault(name, StageTotals())
+            totals.calls += 1
+            totals.wall += measurement["wall"]
+            totals.cpu += measurement["cpu"]
+            totals.bytes_read += measurement["bytes_read"]
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    # Microseconds since the start of the build
+                    "ts": (measurement["start_ns"] - self.start_ns) / 1000,
+                    "dur": measurement["wall"] * 1e6,
+                    "pid": measurement["pid"],
+                    "tid": measurement["tid"],
+                    "args": {
+                        "cpu_ms": round(measurement["cpu"] * 1000, 3),
+                        "bytes_read": measurement["bytes_read"],
+                        **args,
+                    },
+                }
+            )
+
+    def report(self) -> str:
+        """A table of the stages, in the order they first ran.
+
+        Wall % is of the whole build, calls running in parallel add up past 100%.
+        """
+        total = time.perf_counter() - self.start
+        lines = [
+            f"{'Stage':<24} {'Calls':>6} {'Wall s':>9} {'CPU s':>9} "
+            f"{'Read MiB':>9} {'Wall %':>7}"
+        ]
+        for name, totals in self.stages.items():
+            lines.append(
+                f"{name:<24} {totals.calls:>6} {totals.wall:>9.3f} {totals.cpu:>9.3f} "
+                f"{totals.bytes_read / 1024**2:>9.1f} {100 * totals.wall / total:>7.1f}"
+            )
+        lines.append(f"{'total':<24} {'':>6} {total:>9.3f}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str):
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fh)
@@ -1,130 +1,690 @@
 #!/usr/bin/env python3
+import abc
+import argparse
 import glob
-import multiprocessing
+import json
 import os
+import resource
+import struct
+import sys
 import time
 import re
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import tinyexif
+from derivatives import (
+    CONTENT_HASHES_FILENAME,
+    DEFAULT_LAYOUT,
+    DERIVATIVES,
+    ContentHashes,
+    Derivative,
+    DerivativeManifest,
+    Layout,
+    add_layout_arguments,
+    file_info,
+    save_json,
+)
+from profiling import Profiler, Timer
 
 try:
     from tqdm import tqdm
 except ImportError:
-    tqdm = lambda x: x
+
+    class tqdm:
+        """No progress bar without tqdm."""
+
+        def __init__(self, iterable=None, total=None):
+            self.iterable = iterable
+
+        def __iter__(self):
+            return iter(self.iterable)
+
+        def update(self, n=1):
+            pass
+
+        def close(self):
+            pass
+
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
 
 basedir = "./img/max_resolution/Portfolio_2024-12"
 
-remove_file_order = True
-
-
-
-ORDER_REGEX = re.compile(r"^__(\d+)_(.*)")
-
-def remove_file_order(path: str) -> str:
-    """Remove the user-specified order from a filename."""
-    if not remove_file_order:
-        return path
-    return os.path.dirname(path) + "/" + ORDER_REGEX.sub(r"\2", os.path.basename(path))
-
-to_thumbnail_dir = lambda path: remove_file_order(path.replace("img/max_resolution/", "img/potato/"))
-to_smaller_dir = lambda path: remove_file_order(path.replace("img/max_resolution/", "img/potato/"))
-os.makedirs(to_thumbnail_dir(basedir), exist_ok=True)
-os.makedirs(to_smaller_dir(basedir), exist_ok=True)
-
-def get_commands(img):
-    fullsize = img
-    thumbnail = to_thumbnail_dir(img)
-    smaller = to_smaller_dir(img)
-
-    # 256x - Resize so that 256px is the width, the height shall be proportional
-    # x256 - Resize so that 256px is the height, the width shall be proportional
-    thumbnail_cmd = [
-        "magick",
-        fullsize,
-        "-auto-orient",
-        "-strip",
-        "-quality",
-        "78",
-        "-resize",
-        "x256",
-        thumbnail,
-    ]
-    webp_cmd = [
-        "magick",
-        fullsize,
-        "-auto-orient",
-        "-strip",
-        "-quality",
-        "78",
-        "-resize",
-        "x256",
-        "-define",
-        "webp:lossless=false",
-        thumbnail + ".webp",
-    ]
-    smaller_cmds = [
-        [
-            "magick",
-            fullsize,
-            "-auto-orient",
-            "-quality",
-            "85",
-            "-resize",
-            "900x900^",
-            "-define",
-            "webp:lossless=false",
-            smaller + "_900.webp",
-        ],
-        [
-            "magick",
-            fullsize,
-            "-auto-orient",
-            "-quality",
-            "92",
-            "-resize",
-            "1500x1500^",
-            "-format",
-            "jpg",
-            smaller + "_1500.jpg",
-        ],
-    ]
-    webp_tiny_cmd = [
-        "magick",
-        fullsize,
-        "-auto-orient",
-        "-strip",
-        "-quality",
-        "75",
-        "-resize",
-        "x96",
-        "-define",
-        "webp:lossless=false",
-        thumbnail + "_tiny.webp",
-    ]
-    return [
-        webp_cmd,
-        webp_tiny_cmd,
-        thumbnail_cmd,
-        *smaller_cmds,
-    ]
-
-
-def run_subprocess(command):
-    import subprocess
-
-    subprocess.run(command)
-
-
-def main():
-    commands = []
-    for img in glob.glob(f"{basedir}/*"):
-        commands += get_commands(img)
-
-    processes = max(2, 2 * os.cpu_count())
-    print("Parallelizing with #processes =", processes)
-
-    pbar = tqdm(total=len(commands))
-    with multiprocessing.Pool(processes=processes) as pool:
-        for _ in pool.imap_unordered(run_subprocess, commands):
-            pbar.update(1)
+STATE_FILENAME = ".resize_state.json"
+PROFILE_FILENAME = "resize-profile.json"
+
+# Assumed when the dimensions can not be read from the header, a 45 MP image
+UNKNOWN_SIZE = (8256, 5504)
+# Interpreter, libraries and codec buffers of every job
+BASE_MEMORY = 64 * 1024**2
+
+
+def get_commands(img, layout: Layout = DEFAULT_LAYOUT):
+    return [derivative.command(img, layout) for derivative in DERIVATIVES]
+
+
+def cascade_command(
+    img: str, derivatives: list[Derivative], layout: Layout = DEFAULT_LAYOUT
+) -> list[str]:
+    """One magick command that decodes the original once and writes every derivative.
+
+    Resizes in a cascade from the largest derivative down to the smallest, so
+    each one is resized from the previous one instead of from the original.
+    """
+    steps = sorted(derivatives, key=Derivative.size, reverse=True)
+    command = ["magick", img, "-auto-orient"]
+    geometry = None
+    stripped = False
+    for index, derivative in enumerate(steps):
+        # Metadata can not be restored once it is stripped
+        assert derivative.strip or not stripped, "Stripped derivatives must be smaller"
+        if derivative.strip and not stripped:
+            command.append("-strip")
+            stripped = True
+        command += ["-quality", str(derivative.quality)]
+        if derivative.geometry != geometry:
+            command += ["-resize", derivative.geometry]
+            geometry = derivative.geometry
+        command += derivative.options
+        if index < len(steps) - 1:
+            command += ["-write", derivative.target(img, layout)]
+        else:
+            command.append(derivative.target(img, layout))
+    return command
+
+
+class ResizeState:
+    """Remembers which original and settings every derivative was made from.
+
+    Like make, a derivative is only regenerated when it is missing, when its
+    original changed, or when the settings used to make it changed: its
+    command, the backend and the pipeline.
+    """
+
+    def __init__(self, path: str, backend: str = "magick", pipeline: str = "cascade"):
+        self.path = path
+        self.backend = backend
+        self.pipeline = pipeline
+        self.targets: dict[str, dict] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                self.targets = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print("Ignoring invalid resize state", path)
+
+    def stale_reason(
+        self, img: str, derivative: Derivative, layout: Layout = DEFAULT_LAYOUT
+    ) -> str | None:
+        """Why the derivative must be regenerated, None if it is up to date."""
+        target = derivative.target(img, layout)
+        try:
+            target_stat = os.stat(target)
+        except FileNotFoundError:
+            return "missing"
+        source_stat = os.stat(img)
+        entry = self.targets.get(target)
+        if entry is None:
+            # Made before the state file existed, trust it if it is newer
+            if target_stat.st_mtime_ns < source_stat.st_mtime_ns:
+                return "older than the original"
+            self.update(img, derivative, layout)
+            return None
+        if entry["source"] != [source_stat.st_size, source_stat.st_mtime_ns]:
+            return "original changed"
+        if entry["fingerprint"] != self.fingerprint(derivative):
+            return "settings changed"
+        return None
+
+    def update(self, img: str, derivative: Derivative, layout: Layout = DEFAULT_LAYOUT):
+        source_stat = os.stat(img)
+        self.targets[derivative.target(img, layout)] = {
+            "source": [source_stat.st_size, source_stat.st_mtime_ns],
+            "fingerprint": self.fingerprint(derivative),
+        }
+
+    def fingerprint(self, derivative: Derivative) -> str:
+        """Changes whenever the derivative would be made differently."""
+        return json.dumps([self.backend, self.pipeline, derivative.fingerprint()])
+
+    def save(self):
+        save_json(self.path, self.targets)
+
+
+def target_size(width: int, height: int, geometry: str) -> tuple[int, int]:
+    """The size ImageMagick's -resize would give, for the geometries used here."""
+    match = re.fullmatch(r"(\d*)x(\d*)(\^?)", geometry)
+    assert match, f"Unsupported geometry {geometry}"
+    max_width, max_height, fill = match.groups()
+    scales = []
+    if max_width:
+        scales.append(int(max_width) / width)
+    if max_height:
+        scales.append(int(max_height) / height)
+    # ^ means the image fills the box, otherwise it fits inside it
+    scale = max(scales) if fill else min(scales)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def read_image_size(img: str) -> tuple[int, int]:
+    """Width and height from the header, without decoding the image."""
+    try:
+        with open(img, "rb") as fh:
+            size = tinyexif.image_size(fh)
+    except (OSError, ValueError, struct.error):
+        size = None
+    return size or UNKNOWN_SIZE
+
+
+def largest_target(size: tuple[int, int], derivatives: tuple[Derivative, ...]) -> int:
+    """Pixels in the largest derivative."""
+    largest = max(derivatives, key=Derivative.size)
+    width, height = target_size(*size, largest.geometry)
+    return width * height
+
+
+def jpeg_draft_scale(img: str, size: tuple[int, int], target: int) -> int:
+    """How much smaller a JPEG is decoded when it is shrunk on load, 1 to 8."""
+    if not img.lower().endswith((".jpg", ".jpeg")):
+        return 1
+    scale = 1
+    while scale < 8 and size[0] * size[1] >= target * (2 * scale) ** 2:
+        scale *= 2
+    return scale
+
+
+class Backend(abc.ABC):
+    """Resizes all the derivatives of one original.
+
+    Every job runs with a number of native threads and a memory estimate,
+    which the backends enforce where the library supports it.
+    """
+
+    available = True
+
+    def __init__(
+        self, threads: int = 1, memory: int = 0, layout: Layout = DEFAULT_LAYOUT
+    ):
+        self.threads = threads
+        self.memory = memory
+        self.layout = layout
+
+    @staticmethod
+    @abc.abstractmethod
+    def estimate_memory(
+        img: str, size: tuple[int, int], derivatives: tuple[Derivative, ...]
+    ) -> int:
+        """Bytes one job needs for an original of the given size."""
+
+    @abc.abstractmethod
+    def resize(self, img: str, derivatives: tuple[Derivative, ...]) -> bool:
+        """Write the derivatives, returning whether all of them succeeded."""
+
+
+class MagickBackend(Backend):
+    """Runs one ImageMagick process per job."""
+
+    # Q16 HDRI builds keep 4 floats per pixel
+    BYTES_PER_PIXEL = 16
+
+    @staticmethod
+    def estimate_memory(
+        img: str, size: tuple[int, int], derivatives: tuple[Derivative, ...]
+    ) -> int:
+        # The whole original is decoded, and -auto-orient or -resize make a copy
+        pixels = 2 * size[0] * size[1] + largest_target(size, derivatives)
+        return pixels * MagickBackend.BYTES_PER_PIXEL + BASE_MEMORY
+
+    def limits(self) -> list[str]:
+        """Beyond the memory limit, ImageMagick caches pixels in mapped files."""
+        limits = ["-limit", "thread", str(self.threads)]
+        if self.memory:
+            limits += ["-limit", "memory", str(self.memory)]
+            limits += ["-limit", "map", str(2 * self.memory)]
+        return limits
+
+    def resize(self, img: str, derivatives: tuple[Derivative, ...]) -> bool:
+        import subprocess
+
+        if len(derivatives) == 1:
+            command = derivatives[0].command(img, self.layout)
+        else:
+            command = cascade_command(img, derivatives, self.layout)
+        # Settings go before the input, and are not part of the fingerprint
+        command[1:1] = self.limits()
+        return subprocess.run(command).returncode == 0
+
+
+class PillowBackend(Backend):
+    """Resizes in-process with Pillow.
+
+    JPEGs are decoded at a reduced scale with draft(), then resized in a
+    cascade from the largest derivative down to the smallest.
+    """
+
+    available = Image is not None
+    # Orientations that swap the width and height
+    TRANSPOSED = {5, 6, 7, 8}
+
+    @staticmethod
+    def estimate_memory(
+        img: str, size: tuple[int, int], derivatives: tuple[Derivative, ...]
+    ) -> int:
+        target = largest_target(size, derivatives)
+        scale = jpeg_draft_scale(img, size, target)
+        # RGB is stored in 4 bytes, and exif_transpose() makes a copy
+        decoded = size[0] * size[1] // scale**2
+        return 4 * (2 * decoded + target) + BASE_MEMORY
+
+    def resize(self, img: str, derivatives: tuple[Derivative, ...]) -> bool:
+        steps = sorted(derivatives, key=Derivative.size, reverse=True)
+        with Image.open(img) as original:
+            width, height = original.size
+            transposed = original.getexif().get(0x0112) in self.TRANSPOSED
+            if transposed:
+                width, height = height, width
+            # Reduce on load, to the smallest scale larger than every derivative
+            draft_size = target_size(width, height, steps[0].geometry)
+            if transposed:
+                draft_size = draft_size[::-1]
+            original.draft("RGB", draft_size)
+            image = ImageOps.exif_transpose(original)
+        metadata = {
+            "exif": image.info.get("exif", b""),
+            "icc_profile": image.info.get("icc_profile"),
+        }
+        for derivative in steps:
+            size = target_size(*image.size, derivative.geometry)
+            if size != image.size:
+                image = image.resize(size, Image.Resampling.LANCZOS)
+            target = derivative.target(img, self.layout)
+            if target.lower().endswith((".jpg", ".jpeg")) and image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(
+                target,
+                quality=derivative.quality,
+                lossless=False,
+                **({} if derivative.strip else metadata),
+            )
+        return True
+
+
+class VipsBackend(Backend):
+    """Resizes in-process with libvips, which shrinks JPEGs on load."""
+
+    available = pyvips is not None
+
+    @staticmethod
+    def estimate_memory(
+        img: str, size: tuple[int, int], derivatives: tuple[Derivative, ...]
+    ) -> int:
+        # The original is streamed, only the largest derivative is kept in memory
+        target = largest_target(size, derivatives)
+        scale = jpeg_draft_scale(img, size, target)
+        buffers = size[0] // scale * 4 * 64
+        return 2 * 4 * target + buffers + BASE_MEMORY
+
+    def resize(self, img: str, derivatives: tuple[Derivative, ...]) -> bool:
+        pyvips.concurrency_set(self.threads)
+        # Cached operations would keep earlier originals in memory
+        pyvips.cache_set_max(0)
+        steps = sorted(derivatives, key=Derivative.size, reverse=True)
+        header = pyvips.Image.new_from_file(img)
+        width, height = header.width, header.height
+        if "orientation" in header.get_fields() and header.get("orientation") >= 5:
+            width, height = height, width
+        # thumbnail() auto-rotates, and shrinks on load for the first size
+        image = None
+        for derivative in steps:
+            size = target_size(width, height, derivative.geometry)
+            if image is None:
+                # Keep the largest size in memory, the original is read sequentially
+                image = pyvips.Image.thumbnail(
+                    img, size[0], height=size[1], size="force"
+                ).copy_memory()
+            elif size != (image.width, image.height):
+                image = image.thumbnail_image(size[0], height=size[1], size="force")
+            image.write_to_file(
+                derivative.target(img, self.layout),
+                Q=derivative.quality,
+                strip=derivative.strip,
+            )
+        return True
+
+
+BACKENDS = {
+    "magick": MagickBackend,
+    "pillow": PillowBackend,
+    "vips": VipsBackend,
+}
+
+
+def run_job(backend_name: str, threads: int, memory: int, layout: Layout, job):
+    """Returns file_info() of every derivative made, None if the job failed,
+    and the measurement of the job for --profile."""
+    img, derivatives = job
+    timer = Timer()
+    backend = BACKENDS[backend_name](threads, memory, layout)
+    infos = None
+    try:
+        if backend.resize(img, derivatives):
+            infos = [file_info(d.target(img, layout)) for d in derivatives]
+    except Exception as err:
+        print(f"Unable to resize {img}: {err}")
+    measurement = timer.stop()
+    if backend_name == "magick":
+        # The original is read by the magick process, not by this one
+        measurement["bytes_read"] += os.path.getsize(img)
+    return job, infos, measurement
+
+
+def physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return 8 * 1024**3
+
+
+def parse_memory(value: str) -> int:
+    """Bytes from sizes like 8GiB, 512M or 1000000, or 50% of the physical memory."""
+    match = re.fullmatch(
+        r"(\d+(?:\.\d+)?)\s*(?:(%)|([KMGT]?)i?B?)", value.strip(), re.I
+    )
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid memory size: {value!r}")
+    number, percent, unit = match.groups()
+    if percent:
+        return int(float(number) / 100 * physical_memory())
+    return int(float(number) * 1024 ** (" KMGT".index(unit.upper() or " ")))
+
+
+parser = argparse.ArgumentParser(
+    description="Resize full size images into the thumbnails and smaller images used by gen.py. "
+    "Only missing or outdated images are generated.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--basedir",
+    "-b",
+    help="Folder where all the full size images are located.",
+    default=basedir,
+)
+add_layout_arguments(parser)
+parser.add_argument(
+    "--pipeline",
+    help="cascade: decode each original once and write all of its derivatives with one magick command. "
+    "separate: one magick command per derivative, decoding the original every time.",
+    choices=["cascade", "separate"],
+    default="cascade",
+)
+parser.add_argument(
+    "--backend",
+    help="magick: run ImageMagick processes. "
+    "pillow or vips: resize in the worker processes with Pillow or pyvips, "
+    "which avoids starting a process per image.",
+    choices=list(BACKENDS),
+    default="magick",
+)
+parser.add_argument(
+    "--jobs",
+    "-j",
+    help="Maximum number of originals resized at the same time.",
+    type=int,
+    default=os.cpu_count(),
+)
+parser.add_argument(
+    "--max-memory",
+    help="Memory budget for all the jobs running at the same time, "
+    "estimated from the dimensions of every original. "
+    "A size like 8GiB or 512M, or a percentage of the physical memory. "
+    "An original that needs more than the budget is resized on its own.",
+    type=parse_memory,
+    default="50%",
+)
+parser.add_argument(
+    "--force",
+    help="Regenerate every derivative, even if it is up to date.",
+    action="store_true",
+)
+parser.add_argument(
+    "--dry-run",
+    help="Only print which derivatives would be regenerated and why.",
+    action="store_true",
+)
+parser.add_argument(
+    "--profile",
+    help="Print the time, CPU time and bytes read of every stage and resize job, "
+    "and write them to this Chrome trace file, which https://ui.perfetto.dev opens.",
+    nargs="?",
+    const=PROFILE_FILENAME,
+    default="",
+)
+
+
+def main(sys_args=sys.argv[1:]):
+    args = parser.parse_args(sys_args)
+    if not BACKENDS[args.backend].available:
+        parser.error(f"Install the Python package for the {args.backend} backend")
+    profiler = Profiler(enabled=bool(args.profile))
+    resize_all(args, Layout.from_args(args), profiler=profiler)
+    if profiler.enabled:
+        print(profiler.report())
+        profiler.write_trace(args.profile)
+        print("Wrote the trace events to", args.profile)
+
+
+def resize_all(
+    args: argparse.Namespace,
+    layout: Layout,
+    images: list[str] | None = None,
+    profiler: Profiler | None = None,
+) -> dict[str, tuple[str, int, int]]:
+    """Make the missing or outdated derivatives of every image in args.basedir.
+
+    Returns file_info() of every derivative that is now up to date, by path.
+    """
+    profiler = profiler or Profiler()
+    if images is None:
+        images = glob.glob(f"{args.basedir}/*")
+    state_dir = layout.to_dir(args.basedir, "thumbnail")
+    os.makedirs(state_dir, exist_ok=True)
+    os.makedirs(layout.to_dir(args.basedir, "smaller"), exist_ok=True)
+    state = ResizeState(
+        os.path.join(state_dir, STATE_FILENAME), args.backend, args.pipeline
+    )
+
+    manifest = None
+    derivatives = {img: DERIVATIVES for img in images}
+    if layout.hashed_names:
+        manifest = DerivativeManifest(layout.manifest_path(args.basedir))
+        hashes = ContentHashes(os.path.join(state_dir, CONTENT_HASHES_FILENAME))
+        # Hashing is limited by I/O, and hashlib releases the GIL
+        with profiler.stage("hash originals"), ThreadPoolExecutor() as executor:
+            digests = dict(zip(images, executor.map(hashes.digest, images)))
+        hashes.forget_missing()
+        hashes.save()
+        derivatives = {
+            img: [
+                derivative.with_content_hash(digests[img]) for derivative in DERIVATIVES
+            ]
+            for img in images
+        }
+
+    # Every job is an original and the derivatives to make from it
+    jobs = []
+    stale_count = 0
+    stale_originals = 0
+    up_to_date = []
+    with profiler.stage("stale check"):
+        for img in images:
+            stale = []
+            for derivative in derivatives[img]:
+                if args.force:
+                    reason = "--force"
+                else:
+                    reason = state.stale_reason(img, derivative, layout)
+                if reason is None:
+                    up_to_date.append(derivative.target(img, layout))
+                    continue
+                if args.dry_run:
+                    print(derivative.target(img, layout), reason)
+                stale.append(derivative)
+            stale_count += len(stale)
+            stale_originals += bool(stale)
+            if args.pipeline == "cascade" and stale:
+                jobs.append((img, tuple(stale)))
+            else:
+                jobs += [(img, (derivative,)) for derivative in stale]
+    print(
+        f"{stale_count} derivatives of {stale_originals} originals to generate, "
+        f"{len(up_to_date)} derivatives are up to date"
+    )
+    if args.dry_run:
+        return {}
+    made = {}
+    try:
+        if jobs:
+            made = run_jobs(jobs, state, args, layout, profiler)
+    finally:
+        state.save()
+    made.update((target, file_info(target)) for target in up_to_date)
+    if manifest is not None:
+        previous = manifest.paths()
+        for img in images:
+            for plain, derivative in zip(DERIVATIVES, derivatives[img]):
+                if derivative.target(img, layout) in made:
+                    manifest.add(
+                        plain.target(img, layout), derivative.target(img, layout)
+                    )
+        # All the originals, images may only be the ones that changed
+        manifest.keep(
+            {
+                plain.target(img, layout)
+                for img in glob.glob(f"{args.basedir}/*")
+                for plain in DERIVATIVES
+            }
+        )
+        manifest.save()
+        remove_orphans(previous - manifest.paths(), state)
+    return made
+
+
+def remove_orphans(paths: set[str], state: ResizeState):
+    """Delete hashed derivatives the manifest no longer points to.
+
+    They were made from an older original or other settings, and would
+    otherwise stay in the thumbnail folders and be uploaded.
+    """
+    # The manifest joins its folder and relative paths, e.g. ../smaller/
+    targets = {os.path.normpath(target): target for target in state.targets}
+    for path in sorted(paths):
+        state.targets.pop(targets.get(os.path.normpath(path)), None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+    if paths:
+        print(f"Removed {len(paths)} outdated hashed derivatives")
+        state.save()
+
+
+def run_jobs(
+    jobs,
+    state: ResizeState,
+    args: argparse.Namespace,
+    layout: Layout,
+    profiler: Profiler,
+) -> dict[str, tuple[str, int, int]]:
+    """Start jobs in order, as long as they fit in --jobs and --max-memory."""
+    backend = BACKENDS[args.backend]
+    processes = max(1, min(args.jobs, len(jobs)))
+    # Split the cores between the jobs, so native threads do not oversubscribe them
+    threads = max(1, os.cpu_count() // processes)
+    print(
+        f"Parallelizing with up to {processes} processes of {threads} threads "
+        f"and {args.max_memory / 1024**2:.0f} MiB of memory"
+    )
+
+    start = time.perf_counter()
+    pending = deque(
+        (job, backend.estimate_memory(job[0], read_image_size(job[0]), job[1]))
+        for job in jobs
+    )
+    # Memory estimate of every running job
+    running = {}
+    used_memory = 0
+    most_running = 0
+    made = {}
+    pbar = tqdm(total=len(jobs))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while pending or running:
+            while pending and len(running) < processes:
+                (img, derivatives), memory = pending[0]
+                if running and used_memory + memory > args.max_memory:
+                    break
+                if memory > args.max_memory:
+                    print(
+                        f"{img} needs about {memory / 1024**2:.0f} MiB, "
+                        "more than --max-memory, resizing it on its own"
+                    )
+                pending.popleft()
+                future = executor.submit(
+                    run_job,
+                    args.backend,
+                    threads,
+                    memory,
+                    layout,
+                    (img, derivatives),
+                )
+                running[future] = memory
+                used_memory += memory
+                most_running = max(most_running, len(running))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                used_memory -= running.pop(future)
+                (img, derivatives), infos, measurement = future.result()
+                profiler.record(
+                    "resize job",
+                    measurement,
+                    image=img,
+                    derivatives=[derivative.name for derivative in derivatives],
+                )
+                if infos is not None:
+                    for derivative, info in zip(derivatives, infos):
+                        state.update(img, derivative, layout)
+                        made[derivative.target(img, layout)] = info
+                pbar.update(1)
+    pbar.close()
+    elapsed = time.perf_counter() - start
+    originals = len({img for img, _ in jobs})
+    # Includes the magick processes, which were waited for by the workers
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    print(
+        f"Resized {originals} originals in {elapsed:.2f}s, "
+        f"{originals / elapsed:.2f} images/sec "
+        f"with the {args.backend} backend and {args.pipeline} pipeline, "
+        f"peak RSS of one process {peak_rss / 1024:.1f} MiB, "
+        f"at most {most_running} jobs at once"
+    )
+    return made
 
 
 if __name__ == "__main__":
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""Minimal EXIF reader for JPEG, PNG and WebP files.
+
+Only the container headers are read: parsing stops at the APP1/eXIf/EXIF
+block or at the frame header, and only the tags gen.py displays are decoded. No maker notes, no
+thumbnails. The returned tags mimic exifread's, so exifread remains a drop-in
+fallback for anything this module does not understand. image_size() also
+reads the dimensions of AVIF files, from their ispe property.
+
+Run this file directly to benchmark it against exifread:
+
+    ./tinyexif.py img/max_resolution/Portfolio_2024-12/*
+"""
+
+import struct
+import sys
+import time
+from fractions import Fraction
+from typing import Any, BinaryIO, Iterator, NamedTuple
+
+# Tags in the first IFD, named like exifread does
+IMAGE_TAGS = {
+    0x010F: "Image Make",
+    0x0110: "Image Model",
+    0x0132: "Image DateTime",
+    0x013B: "Image Artist",
+}
+# Tags in the EXIF sub-IFD
+EXIF_TAGS = {
+    0x829A: "EXIF ExposureTime",
+    0x829D: "EXIF FNumber",
+    0x8827: "EXIF ISOSpeedRatings",
+    0x920A: "EXIF FocalLength",
+    0x9286: "EXIF UserComment",
+}
+EXIF_IFD_POINTER = 0x8769
+
+# TIFF field type: (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ("B", 1),  # BYTE
+    2: ("s", 1),  # ASCII
+    3: ("H", 2),  # SHORT
+    4: ("I", 4),  # LONG
+    5: ("II", 8),  # RATIONAL
+    6: ("b", 1),  # SBYTE
+    7: ("B", 1),  # UNDEFINED
+    8: ("h", 2),  # SSHORT
+    9: ("i", 4),  # SLONG
+    10: ("ii", 8),  # SRATIONAL
+}
+ASCII = 2
+RATIONAL_TYPES = (5, 10)
+
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_HEADER = b"Exif\x00\x00"
+# Start of frame, except DHT, JPG and DAC which share the range
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# ISOBMFF brands of AVIF images and image sequences
+AVIF_BRANDS = {b"avif", b"avis"}
+# AVIF boxes containing the image properties: bytes before their first child
+AVIF_CONTAINERS = {b"meta": 4, b"iprp": 0, b"ipco": 0}
+
+
+class UnsupportedFormat(ValueError):
+    """The file is not an image this module understands."""
+
+
+class Ratio(Fraction):
+    """A fraction that prints like exifread's Ratio, e.g. 1/250"""
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class Tag(NamedTuple):
+    """The subset of exifread's IfdTag used by gen.py"""
+
+    values: Any
+    printable: str
+
+
+def jpeg_segments(fh: BinaryIO) -> Iterator[tuple[int, int]]:
+    """Yield (marker, payload length) of the segments before the image data.
+
+    The file is positioned at the start of the payload of the yielded segment.
+    """
+    while True:
+        marker = fh.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return
+        while marker[1] == 0xFF:
+            # Fill bytes
+            marker = marker[1:] + fh.read(1)
+        if marker[1] == 0xD8 or 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+            # Markers without a payload
+            continue
+        if marker[1] in (0xDA, 0xD9):
+            # Start of scan or end of image
+            return
+        (length,) = struct.unpack(">H", fh.read(2))
+        start = fh.tell()
+        yield marker[1], length - 2
+        fh.seek(start + length - 2)
+
+
+def png_chunks(fh: BinaryIO) -> Iterator[tuple[bytes, int]]:
+    """Yield (chunk type, length) of the chunks before the image data."""
+    while True:
+        header = fh.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in (b"IDAT", b"IEND"):
+            return
+        start = fh.tell()
+        yield chunk_type, length
+        # Skip the data and CRC
+        fh.seek(start + length + 4)
+
+
+def webp_chunks(fh: BinaryIO) -> Iterator[tuple[bytes, int]]:
+    """Yield (chunk type, length) of the chunks of a RIFF WebP file."""
+    while True:
+        header = fh.read(8)
+        if len(header) < 8:
+            return
+        chunk_type, length = struct.unpack("<4sI", header)
+        start = fh.tell()
+        yield chunk_type, length
+        # Chunks are padded to an even size
+        fh.seek(start + length + (length & 1))
+
+
+def isobmff_boxes(fh: BinaryIO, end: int | None = None) -> Iterator[tuple[bytes, int]]:
+    """Yield (box type, payload length) of the boxes before end, or the file end."""
+    while end is None or fh.tell() < end:
+        header = fh.read(8)
+        if len(header) < 8:
+            return
+        length, box_type = struct.unpack(">I4s", header)
+        if length == 1:
+            (length,) = struct.unpack(">Q", fh.read(8))
+            length -= 8
+        if length == 0:
+            # The last box, up to the end of the file
+            yield box_type, -1
+            return
+        start = fh.tell()
+        yield box_type, length - 8
+        fh.seek(start + length - 8)
+
+
+def read_jpeg_exif(fh: BinaryIO) -> bytes | None:
+    """Return the TIFF block of the APP1 segment, stopping at the image data."""
+    for marker, length in jpeg_segments(fh):
+        if marker == 0xE1 and fh.read(len(EXIF_HEADER)) == EXIF_HEADER:
+            return fh.read(length - len(EXIF_HEADER))
+    return None
+
+
+def read_png_exif(fh: BinaryIO) -> bytes | None:
+    """Return the contents of the eXIf chunk, stopping at the image data."""
+    for chunk_type, length in png_chunks(fh):
+        if chunk_type == b"eXIf":
+            return fh.read(length)
+    return None
+
+
+def read_webp_exif(fh: BinaryIO) -> bytes | None:
+    """Return the contents of the EXIF chunk of a RIFF WebP file."""
+    for chunk_type, length in webp_chunks(fh):
+        if chunk_type == b"EXIF":
+            # Some writers keep the JPEG APP1 header
+            return fh.read(length).removeprefix(EXIF_HEADER)
+    return None
+
+
+def read_jpeg_size(fh: BinaryIO) -> tuple[int, int] | None:
+    for marker, _ in jpeg_segments(fh):
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack(">BHH", fh.read(5))
+            return width, height
+    return None
+
+
+def read_png_size(fh: BinaryIO) -> tuple[int, int] | None:
+    for chunk_type, _ in png_chunks(fh):
+        if chunk_type == b"IHDR":
+            return struct.unpack(">II", fh.read(8))
+    return None
+
+
+def read_webp_size(fh: BinaryIO) -> tuple[int, int] | None:
+    for chunk_type, _ in webp_chunks(fh):
+        data = fh.read(10)
+        if chunk_type == b"VP8X":
+            # 24 bit canvas width and height minus one, after 4 bytes of flags
+            width = int.from_bytes(data[4:7], "little") + 1
+            height = int.from_bytes(data[7:10], "little") + 1
+            return width, height
+        if chunk_type == b"VP8 ":
+            # 14 bits each, after the frame tag and start code
+            width, height = struct.unpack("<HH", data[6:10])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk_type == b"VP8L":
+            # 14 bits each minus one, after the signature byte
+            (bits,) = struct.unpack("<I", data[1:5])
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    return None
+
+
+def read_avif_size(fh: BinaryIO) -> tuple[int, int] | None:
+    """The largest ispe property, tiles of a grid are smaller than the image."""
+    sizes = []
+
+    def find_sizes(end: int | None):
+        for box_type, length in isobmff_boxes(fh, end):
+            start = fh.tell()
+            if box_type in AVIF_CONTAINERS:
+                fh.seek(start + AVIF_CONTAINERS[box_type])
+                find_sizes(start + length)
+                if box_type == b"meta":
+                    # The image data follows
+                    return
+            elif box_type == b"ispe":
+                # After 4 bytes of version and flags
+                sizes.append(struct.unpack(">II", fh.read(12)[4:]))
+
+    find_sizes(None)
+    return max(sizes, key=lambda size: size[0] * size[1], default=None)
+
+
+def detect_format(fh: BinaryIO) -> str:
+    """Return jpeg, png, webp or avif, leaving the file after the signature."""
+    start = fh.read(12)
+    if start.startswith(JPEG_SOI):
+        fh.seek(len(JPEG_SOI))
+        return "jpeg"
+    if start.startswith(PNG_SIGNATURE):
+        fh.seek(len(PNG_SIGNATURE))
+        return "png"
+    if start[:4] == b"RIFF" and start[8:12] == b"WEBP":
+        return "webp"
+    if start[4:8] == b"ftyp":
+        # The major brand, then the minor version and the compatible brands
+        (length,) = struct.unpack(">I", start[:4])
+        brands = start[8:12] + fh.read(max(0, length - 12))[4:]
+        if AVIF_BRANDS & {brands[i : i + 4] for i in range(0, len(brands), 4)}:
+            return "avif"
+    raise UnsupportedFormat("Not a JPEG, PNG, WebP or AVIF file")
+
+
+def read_exif_block(fh: BinaryIO) -> bytes | None:
+    """Find the raw TIFF-formatted EXIF block, None if the image has no EXIF."""
+    readers = {"jpeg": read_jpeg_exif, "png": read_png_exif, "webp": read_webp_exif}
+    image_format = detect_format(fh)
+    if image_format not in readers:
+        raise UnsupportedFormat(f"EXIF of {image_format} files is not supported")
+    return readers[image_format](fh)
+
+
+def image_size(fh: BinaryIO) -> tuple[int, int] | None:
+    """Width and height of the image, as stored, read from its header."""
+    readers = {
+        "jpeg": read_jpeg_size,
+        "png": read_png_size,
+        "webp": read_webp_size,
+        "avif": read_avif_size,
+    }
+    return readers[detect_format(fh)](fh)
+
+
+def make_string(values: list[int]) -> str:
+    """Keep only printable characters, like exifread does."""
+    return "".join(chr(char) for char in values if 32 <= char < 256).strip(" \x00")
+
+
+def make_user_comment(values: list[int]) -> str:
+    """The first 8 bytes of a UserComment are its character code."""
+    if make_string(values[:8]).upper() in ("ASCII", "UNICODE", "JIS", ""):
+        values = values[8:]
+    return make_string(values)
+
+
+def read_field(
+    data: bytes, endian: str, field_type: int, count: int, offset: int
+) -> tuple[Any, str]:
+    """Decode one IFD field into exifread-style (values, printable)."""
+    if field_type == ASCII:
+        value = data[offset : offset + count].split(b"\x00", 1)[0]
+        text = value.decode("utf-8", errors="replace")
+        return text, text
+    fmt, size = FIELD_TYPES[field_type]
+    raw = struct.unpack_from(f"{endian}{fmt * count}", data, offset)
+    if field_type in RATIONAL_TYPES:
+        values = []
+        for numerator, denominator in zip(raw[::2], raw[1::2]):
+            if denominator == 0:
+                return [None], f"{numerator}/{denominator}"
+            values.append(Ratio(numerator, denominator))
+    else:
+        values = list(raw)
+    if count == 1:
+        return values, str(values[0])
+    return values, str(values)
+
+
+def read_ifd(
+    data: bytes,
+    endian: str,
+    ifd_offset: int,
+    tag_names: dict[int, str],
+    tags: dict[str, Tag],
+) -> int | None:
+    """Decode the wanted tags of one IFD, return the EXIF sub-IFD offset if any."""
+    exif_ifd = None
+    (entries,) = struct.unpack_from(f"{endian}H", data, ifd_offset)
+    for entry in range(entries):
+        entry_offset = ifd_offset + 2 + 12 * entry
+        tag, field_type, count = struct.unpack_from(f"{endian}HHI", data, entry_offset)
+        if field_type not in FIELD_TYPES:
+            continue
+        value_offset = entry_offset + 8
+        if FIELD_TYPES[field_type][1] * count > 4:
+            (value_offset,) = struct.unpack_from(f"{endian}I", data, value_offset)
+        if tag == EXIF_IFD_POINTER:
+            (exif_ifd,) = struct.unpack_from(f"{endian}I", data, value_offset)
+        elif tag in tag_names:
+            values, printable = read_field(
+                data, endian, field_type, count, value_offset
+            )
+            if tag_names[tag] == "EXIF UserComment" and isinstance(values, list):
+                printable = make_user_comment(values)
+            tags[tag_names[tag]] = Tag(values, printable)
+    return exif_ifd
+
+
+def parse_tiff(data: bytes) -> dict[str, Tag]:
+    """Decode the gen.py tags of a TIFF-formatted EXIF block."""
+    if data[:2] == b"II":
+        endian = "<"
+    elif data[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Invalid EXIF byte order")
+    _, ifd0 = struct.unpack_from(f"{endian}HI", data, 2)
+    tags: dict[str, Tag] = {}
+    exif_ifd = read_ifd(data, endian, ifd0, IMAGE_TAGS, tags)
+    if exif_ifd:
+        read_ifd(data, endian, exif_ifd, EXIF_TAGS, tags)
+    return tags
+
+
+def process_file(fh: BinaryIO) -> dict[str, Tag]:
+    """Extract EXIF tags from an image file, like exifread.process_file.
+
+    Raises UnsupportedFormat, ValueError or struct.error if the file can not be
+    parsed; use exifread for those.
+    """
+    data = read_exif_block(fh)
+    if not data:
+        return {}
+    return parse_tiff(data)
+
+
+def benchmark(paths: list[str]):
+    """Compare speed and results against exifread."""
+    import exifread
+
+    readers = {
+        "tinyexif": process_file,
+        "exifread": lambda fh: exifread.process_file(fh, extract_thumbnail=False),
+    }
+    results: dict[str, dict[str, dict[str, str]]] = {}
+    for name, reader in readers.items():
+        results[name] = {}
+        start = time.perf_counter()
+        for path in paths:
+            with open(path, "rb") as fh:
+                try:
+                    tags = reader(fh)
+                except (ValueError, struct.error):
+                    tags = {}
+            results[name][path] = {
+                tag: value.printable
+                for tag, value in tags.items()
+                if tag in IMAGE_TAGS.values() or tag in EXIF_TAGS.values()
+            }
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {len(paths)} files in {elapsed:.3f}s, "
+            f"{1000 * elapsed / max(1, len(paths)):.3f}ms per file"
+        )
+    for path in paths:
+        if results["tinyexif"][path] != results["exifread"][path]:
+            print(f"Mismatch for {path}:")
+            print("  tinyexif:", results["tinyexif"][path])
+            print("  exifread:", results["exifread"][path])
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Upload the full size images and all their derivatives to an S3 bucket.
+
+Objects whose size and ETag already match the local file are skipped, so an
+interrupted upload continues where it stopped when run again.
+"""
+
+import argparse
+import hashlib
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+try:
+    from tqdm import tqdm
+except ImportError:
+
+    class tqdm:
+        """No progress bar without tqdm."""
+
+        def __init__(self, iterable=None, total=None):
+            self.iterable = iterable
+
+        def __iter__(self):
+            return iter(self.iterable)
+
+        def update(self, n=1):
+            pass
+
+        def close(self):
+            pass
+
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:
+    boto3 = None
+
+import gen
+from derivatives import ContentHashes, Layout, add_layout_arguments, remove_file_order
+
+ETAGS_FILENAME = ".s3_etags.json"
+# Same as the AWS CLI, so the ETags of objects it uploaded match too
+PART_SIZE = 8 * 1024**2
+# Hashed names never change content, see --hashed-names
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--basedir",
+    "-b",
+    help="Folder where all the full size images are located. "
+    "Example: ./img/max_resolution/Portfolio_2024-12",
+    required=True,
+)
+add_layout_arguments(parser)
+parser.add_argument(
+    "--aws-s3-bucket-url",
+    "--bucket-url",
+    help="The same bucket root URL given to gen.py. "
+    "Example: https://s3.us-east-6.amazonaws.com/your.bucket.name/",
+    required=True,
+)
+parser.add_argument(
+    "--pathroot",
+    "--root",
+    "-r",
+    help="The same path root given to gen.py, replaced by the bucket root URL.",
+    default="./",
+)
+parser.add_argument(
+    "--endpoint-url",
+    help="S3 compatible endpoint, e.g. http://localhost:9000 for MinIO. "
+    "Defaults to the host of --aws-s3-bucket-url, unless it is an AWS bucket host.",
+    default=None,
+)
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    help="Number of files uploaded at the same time, over a shared connection pool.",
+    default=16,
+)
+parser.add_argument(
+    "--cache-control",
+    help="Cache-Control of files that keep their name when they change, "
+    "checked again by browsers once it expires. "
+    f"Derivatives with hashed names always get '{IMMUTABLE_CACHE_CONTROL}'.",
+    default="public, max-age=3600, must-revalidate",
+)
+parser.add_argument(
+    "--dry-run",
+    help="Only print which files would be uploaded.",
+    action="store_true",
+)
+
+
+def s3_etag(fh) -> str:
+    """The ETag of a file uploaded by upload_file().
+
+    The MD5 of small files, or the MD5 of the MD5 of every part and the number
+    of parts for multipart uploads.
+    """
+    digests = [hashlib.md5(chunk).digest() for chunk in iter_parts(fh)]
+    if not digests:
+        return hashlib.md5().hexdigest()
+    if len(digests) == 1:
+        return digests[0].hex()
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def iter_parts(fh):
+    return iter(lambda: fh.read(PART_SIZE), b"")
+
+
+def parse_bucket_url(url: str) -> tuple[str | None, str, str]:
+    """Endpoint URL, bucket and key prefix of a bucket root URL.
+
+    Both https://BUCKET.s3.REGION.amazonaws.com/PREFIX and path style
+    https://s3.REGION.amazonaws.com/BUCKET/PREFIX are understood.
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    path = parsed.path.lstrip("/")
+    if ".s3." in host and host.endswith(".amazonaws.com"):
+        return None, host.split(".s3.")[0], path
+    bucket, _, prefix = path.partition("/")
+    return f"{parsed.scheme}://{parsed.netloc}", bucket, prefix
+
+
+def region_of(url: str) -> str | None:
+    """Region of an AWS bucket host, us-east-1 for the hosts without one.
+
+    e.g. s3.eu-west-3.amazonaws.com, BUCKET.s3-eu-west-3.amazonaws.com or
+    BUCKET.s3.amazonaws.com
+    """
+    parts = (urlparse(url).hostname or "").split(".")
+    if parts[-2:] != ["amazonaws", "com"] or len(parts) < 3:
+        return None
+    region = parts[-3]
+    if region in ("s3", "s3-external-1"):
+        return "us-east-1"
+    return region.removeprefix("s3-")
+
+
+def list_files(args: argparse.Namespace) -> dict[str, tuple[str, str]]:
+    """The local path and Cache-Control of every object, by key."""
+    layout = Layout.from_args(args)
+    basedir = gen.get_basedir(args)
+    _, _, prefix = parse_bucket_url(args.aws_s3_bucket_url)
+    context = gen.BuildContext(1)
+    try:
+        all_filepaths = context.paths_for(basedir, layout)
+        originals = sorted(context.glob(basedir))
+        # Every missing derivative is reported before anything is uploaded
+        context.verify(originals, all_filepaths)
+        files = {}
+        for original in originals:
+            paths = all_filepaths(original)
+            # The same URLs gen.py links to, the full size image has no order
+            keys = {
+                name: prefix + path.replace(args.pathroot, "")
+                for name, path in paths.items()
+            }
+            keys["fullsize"] = prefix + remove_file_order(original).replace(
+                args.pathroot, ""
+            )
+            for name, path in paths.items():
+                immutable = layout.hashed_names and name != "fullsize"
+                cache_control = (
+                    IMMUTABLE_CACHE_CONTROL if immutable else args.cache_control
+                )
+                files[keys[name]] = (path, cache_control)
+    finally:
+        context.close()
+    return files
+
+
+def list_bucket(client, bucket: str, prefix: str) -> dict[str, tuple[int, str]]:
+    """Size and ETag of every object, with one listing of the whole prefix."""
+    objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+    return objects
+
+
+def list_multipart_uploads(client, bucket: str, prefix: str) -> dict[str, str]:
+    """Upload ID of the latest interrupted multipart upload of every key."""
+    uploads = {}
+    paginator = client.get_paginator("list_multipart_uploads")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for upload in sorted(page.get("Uploads", []), key=lambda u: u["Initiated"]):
+            uploads[upload["Key"]] = upload["UploadId"]
+    return uploads
+
+
+def upload_file(
+    client, bucket: str, key: str, path: str, extra: dict, upload_id: str | None
+) -> int:
+    """Upload one file, resuming its multipart upload if upload_id is given.
+
+    Returns the number of bytes sent.
+    """
+    if os.path.getsize(path) <= PART_SIZE:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        client.put_object(Bucket=bucket, Key=key, Body=data, **extra)
+        return len(data)
+
+    uploaded = {}
+    if upload_id:
+        paginator = client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                uploaded[part["PartNumber"]] = part["ETag"].strip('"')
+    else:
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **extra)[
+            "UploadId"
+        ]
+    sent = 0
+    parts = []
+    with open(path, "rb") as fh:
+        for number, chunk in enumerate(iter_parts(fh), start=1):
+            etag = hashlib.md5(chunk).hexdigest()
+            # Parts sent before an interruption are not sent again
+            if uploaded.get(number) != etag:
+                etag = client.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=chunk,
+                )["ETag"]
+                sent += len(chunk)
+            parts.append({"ETag": etag, "PartNumber": number})
+    client.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+    )
+    return sent
+
+
+def main(sys_args=sys.argv[1:]):
+    args = parser.parse_args(sys_args)
+    if boto3 is None:
+        parser.error("Install boto3 to upload to S3")
+    endpoint_url, bucket, prefix = parse_bucket_url(args.aws_s3_bucket_url)
+    client = boto3.session.Session().client(
+        "s3",
+        endpoint_url=args.endpoint_url or endpoint_url,
+        region_name=region_of(args.aws_s3_bucket_url),
+        # One connection per thread, reused for every file
+        config=Config(
+            max_pool_connections=args.jobs,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+        ),
+    )
+
+    try:
+        files = list_files(args)
+    except AssertionError as err:
+        sys.exit(str(err))
+    etags = ContentHashes(
+        os.path.join(
+            Layout.from_args(args).to_dir(gen.get_basedir(args), "thumbnail"),
+            ETAGS_FILENAME,
+        ),
+        hash_file=s3_etag,
+    )
+    remote = list_bucket(client, bucket, prefix)
+    uploads = list_multipart_uploads(client, bucket, prefix)
+
+    def unchanged(key: str) -> bool:
+        path = files[key][0]
+        size, etag = remote.get(key, (None, None))
+        # Files that are missing or have another size are not hashed
+        return size == os.path.getsize(path) and etag == etags.digest(path)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        changed = [
+            key for key, ok in zip(files, executor.map(unchanged, files)) if not ok
+        ]
+    etags.save()
+    print(f"{len(changed)} files to upload, {len(files) - len(changed)} are unchanged")
+    if not changed:
+        return
+    if args.dry_run:
+        for key in changed:
+            print(files[key][0], "->", key)
+        return
+
+    start = time.perf_counter()
+    sent = 0
+    failed = 0
+    pbar = tqdm(total=len(changed))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for key in changed:
+            path, cache_control = files[key]
+            extra = {
+                "ContentType": mimetypes.guess_type(path)[0]
+                or "application/octet-stream",
+                "CacheControl": cache_control,
+            }
+            futures[
+                executor.submit(
+                    upload_file, client, bucket, key, path, extra, uploads.get(key)
+                )
+            ] = key
+        for future in as_completed(futures):
+            try:
+                sent += future.result()
+            except Exception as err:
+                print(f"Unable to upload {futures[future]}: {err}")
+                failed += 1
+            pbar.update(1)
+    pbar.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Uploaded {len(changed) - failed} files, {sent / 1024**2:.1f} MiB "
+        f"in {elapsed:.2f}s, {failed} failed"
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Wait for files to change in a few folders, for gallery.py build --watch.
+
+Uses inotify through ctypes on Linux, so the folders are not scanned while
+nothing happens. Elsewhere, or with a poll interval, every folder is listed
+with one scandir() per interval and the size and mtime of its files compared.
+Hidden files are ignored, gen.py keeps its EXIF cache next to the originals.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError, TypeError):
+    libc = None
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+# A file is only reported once it is completely written, not on IN_CREATE
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# struct inotify_event without its name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+def ignored(name: str) -> bool:
+    return name.startswith(".")
+
+
+class Inotify:
+    """Changed paths in the folders, as reported by the kernel."""
+
+    available = libc is not None
+
+    def __init__(self, directories: list[str]):
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: dict[int, str] = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, os.strerror(errno), directory)
+            self.directories[wd] = directory
+
+    def read(self, timeout: float | None) -> set[str]:
+        """Paths changed within timeout seconds, or forever if it is None.
+
+        A folder is reported itself when its events were lost, or when it was
+        moved or deleted.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return set()
+            changed = self.read_events()
+            # Only ignored files changed otherwise
+            if changed:
+                return changed
+
+    def read_events(self) -> set[str]:
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.directories.values())
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    changed.add(self.directories[wd])
+                elif wd in self.directories and not ignored(name):
+                    changed.add(os.path.join(self.directories[wd], name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Changed paths in the folders, found by comparing listings."""
+
+    def __init__(self, directories: list[str], interval: float = DEFAULT_POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self) -> dict[str, tuple[int, int] | None]:
+        """(size, mtime_ns) of every file, None for a missing folder."""
+        files = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if ignored(entry.name):
+                            continue
+                        try:
+                            if entry.is_file():
+                                stat = entry.stat()
+                                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                        except FileNotFoundError:
+                            # Deleted since the listing, like it was never there
+                            pass
+            except FileNotFoundError:
+                files[directory] = None
+        return files
+
+    def read(self, timeout: float | None) -> set[str]:
+        """Paths changed within timeout seconds, or forever if it is None."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = self.scan()
+            changed = {
+                path
+                for path in files.keys() | self.files.keys()
+                if files.get(path) != self.files.get(path)
+            }
+            self.files = files
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+def open_watcher(directories: list[str], poll_interval: float = 0):
+    """inotify unless it is unavailable or a poll interval is given."""
+    if not poll_interval and Inotify.available:
+        try:
+            return Inotify(directories)
+        except OSError:
+            pass
+    return Poller(directories, poll_interval or DEFAULT_POLL_INTERVAL)
+
+
+def wait_for_changes(watcher, debounce: float) -> set[str]:
+    """Block until files change, then until none changed for debounce seconds.
+
+    A batch export from a photo editor is handled as one change.
+    """
+    changed = watcher.read(None)
+    while True:
+        more = watcher.read(debounce)
+        if not more:
+            return changed
+        changed |= more